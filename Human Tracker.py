@@ -1,88 +1,425 @@
 # -*- coding: utf-8 -*-
 """
 Server program for Human Tracker
-Any connecting ESP32-cams must capture 640x480 images
+Connecting ESP32-cams may send any of the resolutions listed in captureProfile.py,
+the server picks each camera's resolution and JPEG quality at runtime
 
 
 @author: Zac
 """
+import sys
 import socket
+import selectors
+import math
 import threading
-import numpy as np
-import cv2
-from collections import OrderedDict
+import time
+import argparse
+from collections import deque
 import tkinter as tk
-from PIL import Image, ImageTk
 
-import centroidtracker as ct
 import floorPlan as fp
+import scheduler as sc
+import frameStream as fs
+import captureProfile as cp
+import discovery as dc
+import occupancyStream as oc
+import cluster as cl
+import checkpoint as ck
+
+# OpenCV, numpy, PIL, scipy (through centroidtracker) and everything that uses them take a while to import,
+# loadModel imports them in the background so the UI appears straight away
+np = None
+cv2 = None
+ct = None
+dt = None
+cs = None
+fc = None
+at = None
+dec = None
+ms = None
 
 # this class keeps track of any required information for each connected ESP32-cam
+# __slots__ keeps each device small and fixed in size since there can be hundreds of them
 class connectedDevice:
+    __slots__ = ("frameBuffer", "image", "imageVersion", "personLocations", "humanTraffic", "previousObjects", "trackOrigins", "trackerFailed",
+                 "trafficDropped", "frameSlot", "profile", "profileConnection", "frameCache", "MAC", "connection", "tracker")
+    
     def __init__(self, MAC, connection):
+        modulesLoaded.wait() # the tracker and frameCache need the modules loadModel imports
+        self.frameBuffer = None # allocated once for the largest image a camera sends, image is a view of it, see decoder.frameBuffer
         self.image = None
-        self.PhotoImage = None
+        self.imageVersion = 0 # goes up every time image changes so the UI knows when it has to be redrawn
         self.personLocations = None
-        self.humanTraffic = []
-        self.previousObjects = OrderedDict()
+        self.humanTraffic = deque(maxlen=maxTrafficEvents) # enter/exit events waiting to be applied, the oldest are dropped if nothing takes them
+        self.trafficDropped = 0 # number of enter/exit events humanTraffic dropped, shown in the memory report
+        self.previousObjects = {} # object ID -> centroid in the previous frame, updated in place
+        self.trackOrigins = {} # object ID -> centroid it was first seen at, only used when the camera has door regions
+        self.trackerFailed = False # True if the tracker couldn't match everyone in the previous frame, tells the cascade to use the full network
+        self.frameSlot = fs.latestFrame() # newest image received by the frameReceiver in "prefetch" and "push" mode
+        self.profile = cp.profileController() # picks the frame size and JPEG quality this camera should use
+        self.profileConnection = None # the connection the current profile was last sent on
+        self.frameCache = fc.duplicateCache() # detection results of the last few images, repeated images skip decoding and detection
         self.MAC = MAC
         self.connection = connection
         self.tracker = ct.CentroidTracker(3) # The argument is the number of frames before a tracked object is considered lost
+        trackState = restoredTracks.pop(MAC, None) # people this camera was tracking when the last checkpoint was taken
+        if trackState is not None:
+            setTrackState(self, trackState)
+    
+    # adds an enter/exit event to humanTraffic, counting the oldest one if it has to be dropped to make room
+    def addTraffic(self, event):
+        if len(self.humanTraffic) == self.humanTraffic.maxlen:
+            self.trafficDropped += 1
+        self.humanTraffic.append(event)
+    
+    # returns what this device is using memory for -> roughly how many bytes, used to size computers for lots of cameras
+    def getMemoryUsage(self):
+        usage = {}
+        usage["record"] = sys.getsizeof(self) + sys.getsizeof(self.previousObjects) + sys.getsizeof(self.trackOrigins) + sys.getsizeof(self.humanTraffic)
+        usage["image"] = self.frameBuffer.nbytes if self.frameBuffer is not None else 0
+        frame = self.frameSlot.data
+        usage["frameSlot"] = len(frame) if frame is not None else 0
+        usage["frameCache"] = self.frameCache.getMemoryUsage()
+        usage["tracker"] = sys.getsizeof(self.tracker.objects) + sys.getsizeof(self.tracker.disappeared) + sum(sys.getsizeof(centroid) for centroid in list(self.tracker.objects.values()))
+        return usage
+
+maxTrafficEvents = 256 # the most enter/exit events a device holds on to
+
+# command line options, with none of them this is a standalone server
+parser = argparse.ArgumentParser(description="Human Tracker server")
+parser.add_argument("--port", type=int, default=25425, help="port the cameras connect to")
+parser.add_argument("--worker", default=None, help="host:port of a coordinator, runs this server as one worker of a cluster, see cluster.py")
+parser.add_argument("--name", default=socket.gethostname(), help="this worker's name in the cluster")
+parser.add_argument("--advertise", default=None, help="address cameras should use to reach this worker")
+arguments = parser.parse_known_args()[0]
 
 # Global Variables
 connections = [] # list of connectedDevices
+devices = {} # MAC -> connectedDevice, the same devices as connections so reconnecting cameras can be found quickly
 connectionsLock = threading.Lock() # prevents connections from being accessed by multiple threads at the same time
 listeningThreadRunning = False
 handoutThreadRunning = False
 workThreadRunning = False
+occupancyThreadRunning = False
+captureMode = "request" # how images are received from the cameras, see frameStream.py
+useCascade = False # if True a YOLOv4-tiny network looks at every frame first and YOLOv4 only runs when it is needed, see cascade.py
+detectorCascade = None # the detectorCascade being used by the workThread, None if it isn't using one
+useAutotune = False # if True the network's backend, target, threads and input width are picked by timing them, see autotune.py
+inputWidth = None # the widest input the network is given, None means images are given to it at their own size
+trackingWidth = 640 # the centroid trackers work in 640x480 coordinates no matter what resolution the camera sends
+trackingHeight = 480 #   so that tracked people don't jump when a camera changes profile
 iterator = 0 # used by the UI to cycle through cameras
 plan = None # floorPlan that will be used to display where people are
+pollScheduler = sc.pollScheduler() # decides how often each camera gets asked for an image
+discoveryService = dc.discoveryService() # answers cameras looking for the brain's IP address
+occupancyServer = oc.occupancyServer() # publishes room counts to other programs over HTTP
 roomPeopleCount = [] # used by the UI to add UI elements based on the floorPlan that gets loaded
+cameraDoors = {} # MAC -> doorRegions of the room the camera is in, cameras without door regions aren't in here
+cameraPort = arguments.port
+clusterLink = None # the link to the coordinator in worker mode, None for a standalone server
+checkpoints = None # saves the room counts and the trackers so a restart carries on where it left off, see checkpoint.py
+restoredTracks = {} # MAC -> tracker state from the checkpoint for cameras that haven't connected yet
+imageView = None # shows images on the canvas, see mosaic.py
+cameraMosaic = None # every camera's image in one grid, shown instead of the selected camera when "Mosaic View" is ticked
+shownImage = None # (MAC, imageVersion) of the image on the canvas, "mosaic" if the mosaic is
+lastMemoryReport = 0.0 # the last time the memory used by the devices was added up
+
+modulesLoaded = threading.Event() # set once loadModel has imported the heavy modules, or failed to
+modelReady = threading.Event() # set once the networks are loaded and have run their warm-up pass
+modelFailed = False # True if the network couldn't be loaded
+modelStatus = "Model: loading" # shown in the UI
+net = None # YOLOv4, loaded once by loadModel and used by every run of the workThread
+fastNet = None # YOLOv4-tiny for the detector cascade, None if it isn't available
+modelSettings = None # backend, target, threads and input width the networks are using, see autotune.py
+networkFiles = ('YOLO/yolov4.cfg', 'YOLO/yolov4.weights')
+fastNetworkFiles = ('YOLO/yolov4-tiny.cfg', 'YOLO/yolov4-tiny.weights')
 
 listeningThread = threading.Thread()
 handoutThread = threading.Thread()
 workThread = threading.Thread()
+occupancyThread = threading.Thread()
+clusterThread = threading.Thread()
+modelThread = threading.Thread()
+
+# runs a blank image through a network so OpenCV does its one off setup now instead of on the first camera image
+def warmUp(network):
+    image = np.zeros((trackingHeight, trackingWidth, 3), dtype=np.uint8)
+    dt.detectPeople(network, image, maxInputWidth=modelSettings["inputWidth"])
+
+# runs in the modelThread as soon as the program starts
+# imports the heavy modules, loads the networks with the saved autotune settings if there are any and warms them up
+# modelReady is set when it is finished so the workThread can start on camera images straight away
+def loadModel():
+    global np, cv2, ct, dt, cs, fc, at, dec, ms
+    global net, fastNet, modelSettings, modelStatus, modelFailed
+    startTime = time.monotonic()
+    
+    try:
+        import numpy as np
+        import cv2
+        import centroidtracker as ct
+        import detector as dt
+        import cascade as cs
+        import frameCache as fc
+        import autotune as at
+        import decoder as dec
+        import mosaic as ms
+    except Exception as error:
+        modelStatus = "Model: failed to load"
+        modelFailed = True
+        print("failed to import the modules the network needs: ", error)
+        modulesLoaded.set() # wakes anything waiting for the modules so it can see they failed
+        return
+    modulesLoaded.set()
+    print("modules imported in {:.1f} s".format(time.monotonic() - startTime))
+    
+    try:
+        net = cv2.dnn.readNetFromDarknet(*networkFiles)
+        modelSettings = at.loadSettings(networkFiles[0])
+        if modelSettings is None:
+            modelSettings = at.defaultSettings
+        at.applySettings(modelSettings, net)
+        modelStatus = "Model: warming up"
+        warmUp(net)
+    except:
+        modelStatus = "Model: failed to load"
+        modelFailed = True
+        print("failed to load " + networkFiles[1])
+        return
+    
+    try:
+        fastNet = cv2.dnn.readNetFromDarknet(*fastNetworkFiles)
+        at.applySettings(modelSettings, fastNet)
+        warmUp(fastNet)
+    except:
+        fastNet = None # the cascade isn't available, everything else still works
+    
+    modelStatus = "Model: ready ({:.1f} s)".format(time.monotonic() - startTime)
+    print(modelStatus)
+    modelReady.set()
+
+# adds a new device to the registry or gives a reconnecting device its new connection
+# the old connection of a reconnecting device is closed so the camera doesn't end up with two
+def registerDevice(mac, connection):
+    connectionsLock.acquire()
+    device = devices.get(mac)
+    if device is None:
+        connectionsLock.release()
+        modulesLoaded.wait() # also set if loadModel failed, listen only calls this once it is set so it never waits there
+        if modelFailed:
+            connection[0].close()
+            print(mac, " refused, the network couldn't be loaded")
+            return
+        device = connectedDevice(mac, connection) # created without the lock since it may have to wait for loadModel
+        connectionsLock.acquire()
+        devices[mac] = device
+        connections.append(device)
+        connectionsLock.release()
+        return
+    oldConnection = device.connection
+    device.connection = connection
+    connectionsLock.release()
+    if oldConnection is not None:
+        oldConnection[0].close()
+    print(mac, " reconnected successfully")
+
+# closes connection and removes it from device, unless the device has already reconnected with a new connection
+# a dropped device stops being scheduled so its share of the budget goes to the cameras that are still connected
+def dropConnection(device, connection):
+    connection[0].close()
+    connectionsLock.acquire()
+    dropped = device.connection is connection
+    if dropped:
+        device.connection = None
+    connectionsLock.release()
+    if dropped:
+        pollScheduler.removeCamera(device.MAC)
+
+# returns (next object ID, [(ID, x, y, frames disappeared, origin or None)]) for a device's tracker, see checkpoint.py
+def getTrackState(device):
+    objects = []
+    for (objectID, centroid) in device.tracker.objects.items():
+        origin = device.trackOrigins.get(objectID)
+        objects.append((objectID, int(centroid[0]), int(centroid[1]), device.tracker.disappeared.get(objectID, 0), origin))
+    return (device.tracker.nextObjectID, objects)
+
+# puts the people a device's tracker was following back, state is what getTrackState returned
+def setTrackState(device, state):
+    nextObjectID, objects = state
+    device.tracker.nextObjectID = nextObjectID
+    for (objectID, x, y, disappeared, origin) in objects:
+        device.tracker.objects[objectID] = np.array([x, y])
+        device.tracker.disappeared[objectID] = disappeared
+        device.previousObjects[objectID] = device.tracker.objects[objectID]
+        if origin is not None:
+            device.trackOrigins[objectID] = origin
+
+# loads the last checkpoint of the floorPlan at filePath, replays the events that were logged after it and starts checkpointing
+def restoreCheckpoint(filePath):
+    global checkpoints
+    startTime = time.monotonic()
+    checkpoints = ck.checkpointer(filePath[:-10])
+    try:
+        counts, cameras, events = checkpoints.restore()
+    except OSError as error:
+        print("couldn't open the checkpoint or event log, carrying on without checkpoints: ", error)
+        checkpoints = None
+        return
+    for (room, people) in counts.items():
+        if room in plan.rooms:
+            plan.rooms[room].peopleCount = people
+    replayedRooms = set()
+    for (eventTime, room, enter, door) in events:
+        if room in plan.rooms:
+            plan.rooms[room].movePerson(door, enter)
+            replayedRooms.add(room)
+    # the tracks in the checkpoint are from before the replayed events, a camera whose room had any of them
+    #   would count the people behind those events again so it starts with an empty tracker instead
+    skippedCameras = set(plan.rooms[room].camera for room in replayedRooms)
+    connectionsLock.acquire()
+    for (MAC, state) in cameras.items():
+        if MAC in skippedCameras:
+            continue
+        device = devices.get(MAC)
+        if device is None:
+            restoredTracks[MAC] = state
+        elif device.tracker.nextObjectID == 0: # a camera that connected before the floorPlan was loaded, unless it has already seen someone
+            setTrackState(device, state)
+    connectionsLock.release()
+    saveCheckpoint() # the replayed events are in this one so they are never replayed twice
+    print("restored ", len(counts), " rooms and ", len(cameras), " cameras and replayed ", len(events), " events in {:.1f} ms".format((time.monotonic() - startTime) * 1000))
 
-# Constantly listens on port 25425 for new connections
+# hands the room counts and the people every camera is tracking to the checkpointer, this has to run on the thread that runs movePeople
+# returns False if the checkpointer is busy starting a new event log and the checkpoint has to be tried again
+def saveCheckpoint():
+    connectionsLock.acquire()
+    # events the trackers queued since movePeople ran are applied in the same hold as the tracks are copied,
+    #   otherwise a track could be gone from the checkpoint while its exit isn't in the counts
+    moved = applyTraffic(plan)
+    counts = getRoomCounts(plan)
+    cameras = dict((device.MAC, getTrackState(device)) for device in connections if len(device.tracker.objects) > 0)
+    connectionsLock.release()
+    if moved and occupancyThreadRunning:
+        occupancyServer.publishCounts(counts)
+    return checkpoints.save(counts, cameras)
+
+# in worker mode, tells a camera this worker doesn't own which worker it should connect to, the caller closes the socket
+def redirectDevice(sock, mac):
+    owner = clusterLink.getOwner(mac)
+    if owner is None:
+        print(mac, " isn't owned by any worker")
+        return
+    try:
+        sock.sendall(("server " + owner[0] + " " + str(owner[1]) + "\n").encode())
+        print(mac, " sent to ", owner[0], ":", owner[1])
+    except:
+        pass
+
+# called by the clusterLink whenever the coordinator changes which cameras this worker owns
+# cameras and previous are MAC -> doorRegions, connected cameras this worker no longer owns are sent to their new owner
+def clusterAssigned(cameras, previous):
+    for MAC in previous:
+        if MAC not in cameras:
+            cameraDoors.pop(MAC, None)
+    for (MAC, doors) in cameras.items():
+        if doors is not None:
+            cameraDoors[MAC] = doors
+        else:
+            cameraDoors.pop(MAC, None)
+    connectionsLock.acquire()
+    lost = [(device, device.connection) for device in connections if device.MAC not in cameras and device.connection is not None]
+    connectionsLock.release()
+    for (device, connection) in lost:
+        redirectDevice(connection[0], device.MAC)
+        dropConnection(device, connection)
+
+# Constantly listens on cameraPort (25425 unless --port is given) for new connections
 # accepts any new connections
+# in worker mode cameras owned by another worker are told to connect to that worker instead
 # new connections are expected to immediately send their MAC address
 # new connections should only be ESP32-cams
+# every waiting connection is accepted at once and all of them wait for their MAC address at the same time,
+#   so a burst of cameras reconnecting after a WiFi dropout doesn't have to queue up behind each other
+# a connection that hasn't sent a full MAC address within 2 seconds is registered with whatever it did send, or closed if it sent nothing
 def listen():
     print("listeningThread started")
     
-    port = 25425
+    port = cameraPort
+    MACLength = 17 # "FC:F5:C4:0C:6F:94"
     listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    listener.settimeout(1)
+    listener.setblocking(False)
     listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
     listener.bind(('', port))
-    listener.listen(5)
+    listener.listen(1024)
+    
+    selector = selectors.DefaultSelector()
+    selector.register(listener, selectors.EVENT_READ, None)
+    pending = {} # socket -> [connection, data received so far, time the MAC has to arrive by]
+    waiting = [] # (MAC, connection) of cameras that finished their handshake before loadModel imported the modules
+    
+    # stops waiting on a pending connection and either registers it or closes it
+    def finishHandshake(sock, accept):
+        connection, data, deadline = pending.pop(sock)
+        selector.unregister(sock)
+        if accept:
+            try:
+                mac = data.decode('utf-8').strip()
+                sock.settimeout(2)
+                if clusterLink is not None and not clusterLink.owns(mac):
+                    redirectDevice(sock, mac)
+                    sock.close()
+                    return
+                if not modulesLoaded.is_set():
+                    # registering would block until the modules are imported, the other handshakes have to keep going meanwhile
+                    waiting.append((mac, connection))
+                    return
+                registerDevice(mac, connection)
+                return
+            except:
+                pass
+        sock.close()
     
-    global connections
     while listeningThreadRunning:
-        connection = None
-        try:
-            connection = listener.accept()
-            connection[0].settimeout(2)
-        except:
-            continue
-        print(str(connection[1][0]) + " connected on port " + str(connection[1][1]))
-        try:
-            mac = connection[0].recv(65535).decode('utf-8')
-        except:
-            connection[0].close()
-            continue
-        reconnect = False
-        for device in connections:
-            if device.MAC == mac:
-                device.connection = connection
-                reconnect = True
-                print(mac, " reconnected successfully")
-                break
-        if reconnect == False:
-            device = connectedDevice(mac, connection)
-            connectionsLock.acquire()
-            connections.append(device)
-            connectionsLock.release()
+        for (key, events) in selector.select(timeout=0.1):
+            if key.data is None:
+                while True:
+                    try:
+                        connection = listener.accept()
+                    except:
+                        break # nothing left waiting
+                    connection[0].setblocking(False)
+                    pending[connection[0]] = [connection, b"", time.monotonic() + 2]
+                    selector.register(connection[0], selectors.EVENT_READ, connection)
+                    print(str(connection[1][0]) + " connected on port " + str(connection[1][1]))
+                continue
+            sock = key.fileobj
+            try:
+                dataReceived = sock.recv(64)
+            except BlockingIOError:
+                continue
+            except:
+                dataReceived = b""
+            if len(dataReceived) == 0:
+                finishHandshake(sock, False)
+                continue
+            pending[sock][1] += dataReceived
+            if len(pending[sock][1]) >= MACLength:
+                finishHandshake(sock, True)
+        
+        now = time.monotonic()
+        for sock in [sock for sock in pending if pending[sock][2] < now]:
+            finishHandshake(sock, len(pending[sock][1]) > 0)
+        
+        if len(waiting) > 0 and modulesLoaded.is_set():
+            for (mac, connection) in waiting:
+                registerDevice(mac, connection)
+            waiting.clear()
+    
+    for sock in list(pending):
+        finishHandshake(sock, False)
+    for (mac, connection) in waiting:
+        connection[0].close()
+    selector.close()
     listener.close()
 
 # constantly listens on port 25426 for requests for the brain's IP address.
@@ -90,201 +427,363 @@ def listen():
 # Message format:
 #         Incoming: "brain address?"
 #         Server responds: "brain address:192.168.1.xxx"
+# the discoveryService caches the address, ignores repeated requests and limits how fast it answers, see discovery.py
 def handoutAddress():
     print("handoutThread started")
     
-    IPDistributorPort = 25426
-    IPDistributor = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    IPDistributor.settimeout(1)
-    IPDistributor.bind(('', IPDistributorPort))
-    
-    while(handoutThreadRunning):
-        try:
-            (message, clientAddress) = IPDistributor.recvfrom(100)
-            if (message.decode('utf-8') == "brain address?"):
-                print("Giving brain IP address to " + str(clientAddress))
-                IP = socket.gethostbyname(socket.gethostname())
-                message = "brain address:" + str(IP)
-                print(message)
-                IPDistributor.sendto(message.encode(), clientAddress)
-        except:
-            continue
-    
-    IPDistributor.close()
+    discoveryService.run(lambda: handoutThreadRunning)
 
 # Simple function used for determining if a centroid is in the left, center, or right side of an image
-# image resolution is always 640x480
-def getDirection(x):
-    if x < 213:
+# width is the width of the image the centroid came from
+def getDirection(x, width=trackingWidth):
+    if x < width / 3:
         return "Left"
-    elif x < 427:
+    elif x < width * 2 / 3:
         return "Middle"
     else:
         return "Right"
 
+# returns the door ("Left", "Middle" or "Right") whose region is closest to a centroid in tracking coordinates
+# doors is a room's doorRegions
+def getDoor(centroid, doors):
+    x = centroid[0] / trackingWidth
+    y = centroid[1] / trackingHeight
+    closestDoor = None
+    closestDistance = None
+    for (door, (x0, y0, x1, y1)) in doors.items():
+        distance = math.hypot(max(x0 - x, 0, x - x1), max(y0 - y, 0, y - y1))
+        if closestDoor is None or distance < closestDistance:
+            closestDoor = door
+            closestDistance = distance
+    return closestDoor
+
+# the direction someone walking through each door into the room moves in the image, in tracking coordinates
+# the Left and Right doors are at the edges of the image so walking in moves away from that edge,
+# the camera faces the Middle door so walking in means walking towards the camera, which moves people down the image
+doorInward = {"Left": (1, 0), "Middle": (0, 1), "Right": (-1, 0)}
+
+# used instead of getDirection when only the door regions are being looked at
+# people disappear as soon as they walk out of a door region into the room, so appearing and disappearing can't be
+#   used to tell if someone entered or exited, instead it looks at where they were first and last seen
+# someone who moved in the door's inward direction walked in through it, someone who moved the other way walked out
+# returns ("enter" or "exit", door), or None if they didn't move far enough to tell
+def getDoorCrossing(origin, last, doors):
+    movementX = last[0] - origin[0]
+    movementY = last[1] - origin[1]
+    minimumMovement = trackingWidth * 0.05
+    door = getDoor(origin, doors)
+    inwardX, inwardY = doorInward[door]
+    if movementX * inwardX + movementY * inwardY > minimumMovement:
+        return ("enter", door)
+    door = getDoor(last, doors)
+    inwardX, inwardY = doorInward[door]
+    if movementX * inwardX + movementY * inwardY < -minimumMovement:
+        return ("exit", door)
+    return None
+
+# sends a newline terminated command to a camera
+# returns False if it couldn't be sent, whoever is receiving images from the camera will notice the dead connection
+def sendCommand(connection, command):
+    try:
+        connection.connection[0].send((command + "\n").encode("utf-8"))
+        return True
+    except:
+        return False
+
 # detectHumans takes an image and a neural network and passes the image through the network
-# the network returns everything it detects in the image
+# the network returns everything it detects in the image, only the door regions are looked at if the camera has any
+# if cascade is given it decides whether net (the full network) needs to look at the image at all
 # the results are stored in connection.image of the connection that was passed to this function
 # labels is simply for converting the nets numeric ouput into a word ex: 0 -> person
-def detectHumans(image, net, connection):
-    layerNames = net.getLayerNames()
-    layerNames = [layerNames[i[0] - 1] for i in net.getUnconnectedOutLayers()]
+# cacheEntry is from the camera's frameCache, the result is stored there in case the camera sends the same image again
+def detectHumans(image, net, connection, cascade=None, cacheEntry=None):
+    startTime = time.monotonic()
     
     height, width = image.shape[:2]
     
-    #blob is the object that the DNN will accept
-    blob = cv2.dnn.blobFromImage(image, 1/255.0, (height, width), swapRB=True, crop=False)
-    net.setInput(blob)
-    outputs = net.forward(layerNames)
-    
-    boxes = []
-    confidences = []
-    classIDs = []
-    requiredConfidence = 0.6
-    
-    for output in outputs:
-        for detection in output:
-            scores = detection[5:]
-            classID = np.argmax(scores)
-            confidence = scores[classID]
-            
-            if confidence > requiredConfidence:
-                if classID == 0: # 0 = person, we don't care about anything else that gets detected
-                    box = detection[0:4] * np.array([width, height, width, height])
-                    centerX, centerY, w, h = box.astype('int')
-                    x = int(centerX - (w / 2))
-                    y = int(centerY - (h / 2))
-                    boxes.append([x, y, int(w), int(h)])
-                    confidences.append(float(confidence))
-                    classIDs.append(classID)
-    
-    idxs = cv2.dnn.NMSBoxes(boxes, confidences, requiredConfidence, 0.3) # 0.5 = minimum required confidence, 0.3 = threshold for non Max suppresion
+    # if the floorPlan describes where the doors are, only the door regions are run through the network
+    doors = cameraDoors.get(connection.MAC)
+    regions = None
+    if doors is not None:
+        regions = dt.scaleRegions(doors.values(), width, height)
+    if cascade is not None:
+        boxes, confidences, reason = cascade.detect(connection.MAC, image, regions, connection.trackerFailed)
+    else:
+        boxes, confidences = dt.detectPeople(net, image, regions, maxInputWidth=inputWidth)
     
     personLocations = []
+    pollScheduler.reportInferenceTime(time.monotonic() - startTime)
     
-    if len(idxs) > 0:
-        for i in idxs.flatten():
-            x, y, w, h = boxes[i][0], boxes[i][1], boxes[i][2], boxes[i][3]
-            
-            color = (0, 255, 0)
-            cv2.rectangle(image, (x, y), (x + w, y + h), color, 2)
-            text = "Person" + " " + str(round(confidences[i],4))
-            cv2.putText(image, text, (x, y -5), cv2.FONT_HERSHEY_SIMPLEX, 0.5, color, 1)
-            
-            centerX = x + w/2
-            centerY = y + h/2
-            personLocations.append((x, y, x + w, y + h))
+    if regions is not None:
+        for (x0, y0, x1, y1) in regions:
+            cv2.rectangle(image, (x0, y0), (x1, y1), (255, 0, 0), 1)
+    
+    for i in range(len(boxes)):
+        x, y, w, h = boxes[i][0], boxes[i][1], boxes[i][2], boxes[i][3]
+        
+        color = (0, 255, 0)
+        cv2.rectangle(image, (x, y), (x + w, y + h), color, 2)
+        text = "Person" + " " + str(round(confidences[i],4))
+        cv2.putText(image, text, (x, y -5), cv2.FONT_HERSHEY_SIMPLEX, 0.5, color, 1)
+        
+        personLocations.append((x, y, x + w, y + h))
+    
+    # lets the camera drop to a cheaper profile if people are still being detected confidently, or go back up if they aren't
+    missed = len(connection.previousObjects) > len(personLocations)
+    newProfile = connection.profile.report(confidences, missed)
+    if newProfile is not None or connection.profileConnection is not connection.connection:
+        if connection.connection is not None and sendCommand(connection, cp.profileCommand(connection.profile.getProfile())):
+            if newProfile is not None:
+                print(connection.MAC, " switched to profile ", newProfile)
+            connection.profileConnection = connection.connection
+    
+    if cacheEntry is not None:
+        connection.frameCache.store(cacheEntry, (personLocations, confidences, width, height))
+    
+    trackPeople(connection, personLocations, width, height, missed, image)
+
+# applies the centroid tracker to the people found in a camera's latest image and records anyone who entered or exited
+# personLocations are (x0, y0, x1, y1) boxes in an image that is width x height
+# missed = True if fewer people were found than were being tracked
+# image is the image the people were found in with the detections drawn on it,
+#   None means the camera sent an image it had already sent so the image being displayed is kept
+def trackPeople(connection, personLocations, width, height, missed, image=None):
+    doors = cameraDoors.get(connection.MAC)
     
     connectionsLock.acquire()
-    #connection.image = image.copy() # OpenCV uses BGR arrays for images
-    connection.image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB) # most other things use RGB arrays so it must be converted
+    if image is not None:
+        #connection.image = image.copy() # OpenCV uses BGR arrays for images
+        # most other things use RGB arrays so it must be converted, the same buffer is written into every time
+        connection.frameBuffer, connection.image = dec.frameBuffer(connection.frameBuffer, image.shape)
+        cv2.cvtColor(image, cv2.COLOR_BGR2RGB, dst=connection.image)
+        connection.imageVersion += 1
     connection.personLocations = personLocations.copy()
     
     # Centroid tracking starts
+    # boxes are scaled to the tracking coordinates, scale is used to get back to this image's coordinates for drawing
+    scale = np.array([trackingWidth / width, trackingHeight / height, trackingWidth / width, trackingHeight / height])
     rects = []
     for box in personLocations:
-        rects.append(np.array(box))
+        rects.append((np.array(box) * scale).astype("int"))
     try:
         objects = connection.tracker.update(rects)
+        events = 0 # humanTraffic is bounded so its length can't be used to count them
         
         for (object, centroid) in connection.previousObjects.items():   # Check if any people disappeared
             if object not in objects:
-                direction = getDirection(centroid[0])
-                print("Object ", object, " exited ", direction, " at ", centroid)
-                connection.humanTraffic.append(("exit", direction))
+                if doors is None:
+                    direction = getDirection(centroid[0])
+                    print("Object ", object, " exited ", direction, " at ", centroid)
+                    connection.addTraffic(("exit", direction))
+                    events += 1
+                else:
+                    crossing = getDoorCrossing(connection.trackOrigins.pop(object, centroid), centroid, doors)
+                    if crossing is not None:
+                        print("Object ", object, " entered " if crossing[0] == "enter" else " exited ", crossing[1], " at ", centroid)
+                        connection.addTraffic(crossing)
+                        events += 1
         for (object, centroid) in objects.items():                      # Check if any people appeared
             if object not in connection.previousObjects:
-                direction = getDirection(centroid[0])
-                print("Object ", object, " entered ", direction, " at ", centroid)
-                connection.humanTraffic.append(("enter", direction))
-        connection.previousObjects = objects.copy()
+                if doors is None:
+                    direction = getDirection(centroid[0])
+                    print("Object ", object, " entered ", direction, " at ", centroid)
+                    connection.addTraffic(("enter", direction))
+                    events += 1
+                else:
+                    connection.trackOrigins[object] = (centroid[0], centroid[1])
+        # the tracker replaces centroids rather than changing them so keeping references is safe
+        connection.previousObjects.clear()
+        connection.previousObjects.update(objects)
+        pollScheduler.reportActivity(connection.MAC, len(objects), events)
+        # someone appeared, disappeared or went undetected, the tracker had to guess
+        connection.trackerFailed = events > 0 or missed or len(objects) != len(rects)
         
-        for (objectID, centroid) in objects.items():
-            cv2.putText(connection.image, "ID " + str(objectID), (centroid[0] - 10, centroid[1] - 10), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 255, 0), 2)
-            cv2.circle(connection.image, (centroid[0], centroid[1]), 4, (0, 255, 0), -1)
+        if image is not None:
+            for (objectID, centroid) in objects.items():
+                x, y = int(centroid[0] / scale[0]), int(centroid[1] / scale[1])
+                cv2.putText(connection.image, "ID " + str(objectID), (x - 10, y - 10), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 255, 0), 2)
+                cv2.circle(connection.image, (x, y), 4, (0, 255, 0), -1)
+            connection.imageVersion += 1
         # Centroid tracking finishes
     except:
         print("tracker crashed")
     connectionsLock.release()
 
-# work first initializes the YOLO deep neural network, this is done once because it takes some time to setup
-# it then continuously loops through the list of active connections and asks for an image
-# when it receives an image it spawns a new thread that will detect any people in the image
-# it then asks for the next image and waits for the previous thread to finish, this is done because receiving the image and detecting people both take over 100ms 
-#   so it makes sense to run them in parallel
+# gives the tracker the same people as the last time the camera sent this image, the image is never decoded
+# result is what detectHumans stored in the camera's frameCache
+def repeatDetection(connection, result):
+    personLocations, confidences, width, height = result
+    trackPeople(connection, personLocations, width, height, len(connection.previousObjects) > len(personLocations))
+
+# sends "send image" to a connection and waits for the whole image to arrive, this is how images are received in "request" mode
+# returns the image data, or None if the connection died
+def requestImage(connection):
+    sock = connection.connection # the listeningThread may replace connection.connection if the camera reconnects
+    try:
+        #print("Requesting image from: ", connection.MAC)
+        sock[0].send("send image".encode("utf-8"))
+    except:
+        print(connection.MAC, " connection closed because request failed")
+        dropConnection(connection, sock)
+        return None
+    imageData = None
+    imageComplete = False
+    
+    while imageComplete == False:
+        try:
+            dataReceived = sock[0].recv(8192)
+        except:
+            print(connection.MAC, " timed out")
+            dropConnection(connection, sock)
+            return None
+        if len(dataReceived) == 0:
+            print(connection.MAC, " connection closed because no data received")
+            dropConnection(connection, sock)
+            return None
+        if imageData == None:
+            imageData = dataReceived
+        else:
+            imageData += dataReceived
+        # the end of image marker may be split between this chunk and the previous one
+        if imageData.find(fs.JPEG_END, max(0, len(imageData) - len(dataReceived) - 1)) != -1:
+            imageComplete = True
+    
+    #print("image captured from: ", connection.MAC)
+    return imageData
+
+# work first waits for loadModel to finish setting up the YOLO deep neural network, this is done once because it takes some time to setup
+#   if autotuning is ticked and this computer hasn't been calibrated yet the network is calibrated first
+# it then continuously loops through the list of active connections and gets an image from every camera the pollScheduler says is due
+#   each pass starts after the last camera that was served so the cameras at the start of the list don't get served first every time
+#   in "request" mode it asks for the image and waits for it
+#   in "prefetch" and "push" mode a frameReceiver collects the images in the background and work just takes the newest one
+# when it receives an image it hands it to a frameDecoder which decodes it on a pool of threads, at a reduced size if the network input is small
+#   only a couple of images are decoded ahead of the detectionThread so the ones it gets are as fresh as possible
+# as soon as the detectionThread is free, the oldest decoded image is given to a new detectionThread that will detect any people in the image
+# receiving, decoding and detecting all take a while so it makes sense to run them in parallel
+# only one detectionThread runs at a time and a camera never has more than one image waiting, so each camera's images are tracked in the order they arrived
 # it then applies a centoid tracker to the post detection image which gives an id number to any detection and keeps track of where they move
 # when a person disappears it reports where they were last seen
 def work():
-    print("workThread started")
+    print("workThread started in " + captureMode + " mode")
     
     global connections
+    global detectorCascade
+    global inputWidth
+    global modelSettings
     
-    net = cv2.dnn.readNetFromDarknet('YOLO/yolov4.cfg', 'YOLO/yolov4.weights')
-    net.setPreferableBackend(cv2.dnn.DNN_BACKEND_OPENCV)
-    net.setPreferableTarget(cv2.dnn.DNN_TARGET_OPENCL)
+    while not modelReady.wait(0.1):
+        if modelFailed or not workThreadRunning:
+            print("workThread stopped, the network isn't available")
+            return
+    
+    # loadModel uses the saved autotune settings if there are any, they are swapped for the defaults if autotuning is off
+    if useAutotune and modelSettings is at.defaultSettings:
+        modelSettings = at.loadOrCalibrate(net, networkFiles[0])
+        at.applySettings(modelSettings, net, *([fastNet] if fastNet is not None else []))
+        warmUp(net)
+    elif not useAutotune and modelSettings is not at.defaultSettings:
+        modelSettings = at.defaultSettings
+        cv2.setNumThreads(-1) # back to OpenCV's own thread count, the defaults don't set one
+        at.applySettings(modelSettings, net, *([fastNet] if fastNet is not None else []))
+        warmUp(net)
+    inputWidth = modelSettings["inputWidth"]
+    
+    detectorCascade = None
+    if useCascade:
+        if fastNet is not None:
+            detectorCascade = cs.detectorCascade(fastNet, net, maxInputWidth=inputWidth)
+        else:
+            print("failed to load YOLO/yolov4-tiny, only the full network will be used")
     
     detectionThread = threading.Thread()
     
+    receiver = None
+    if captureMode != "request":
+        receiver = fs.frameReceiver(captureMode, connections, connectionsLock, pollScheduler, dropConnection)
+        receiver.start()
+    
+    decoder = dec.frameDecoder()
+    pending = deque() # (connection, Future of the decoded image, cacheEntry) waiting for the detectionThread, oldest first
+    maxPending = 2 # images decoded ahead of the detectionThread, any more would only be older by the time they are looked at
+    nextIndex = 0 # index in connections of the camera after the last one that was served, every pass starts there
+    busy = set() # MACs of cameras with an image waiting or being detected
+    detectionMAC = None # MAC of the camera the detectionThread is working on
+    
+    # starts a detectionThread on the oldest decoded image if the last one has finished
+    def startNextDetection():
+        nonlocal detectionThread, detectionMAC
+        if detectionThread.is_alive():
+            return
+        if detectionMAC is not None:
+            busy.discard(detectionMAC)
+            detectionMAC = None
+        while len(pending) > 0 and pending[0][1].done():
+            connection, future, cacheEntry = pending.popleft()
+            image = future.result()
+            if image is None:
+                busy.discard(connection.MAC)
+                continue
+            detectionThread = threading.Thread(target=detectHumans, args=(image, net, connection, detectorCascade, cacheEntry)) # detectionThread created
+            detectionThread.start()
+            detectionMAC = connection.MAC
+            return
+    
     while workThreadRunning:
+        startNextDetection()
         if len(connections) == 0:
+            time.sleep(0.01)
             continue
-        for connection in connections:
-            if connection.connection == None:
+        polled = False
+        count = len(connections) # connections is only ever appended to so indexes stay valid
+        start = nextIndex
+        for offset in range(count):
+            if len(pending) >= maxPending:
+                break # enough images are waiting already, any newer ones are better
+            index = (start + offset) % count
+            connection = connections[index]
+            if connection.MAC in busy:
                 continue
-            try:
-                #print("Requesting image from: ", connection.MAC)
-                connection.connection[0].send("send image".encode("utf-8"))
-            except:
-                print(connection.MAC, " connection closed because request failed")
-                connection.connection[0].close()
-                connection.connection = None
-                continue
-            imageData = None
-            imageComplete = False
-            connectionDied = False
-            
-            while imageComplete == False:
-                try:
-                    dataReceived = connection.connection[0].recv(8192)
-                except:
-                    print(connection.MAC, " timed out")
-                    connection.connection[0].close()
-                    connection.connection = None
-                    connectionDied = True
-                    break
-                if len(dataReceived) == 0:
-                    print(connection.MAC, " connection closed because no data received")
-                    connectionDied = True
-                    connection.connection[0].close()
-                    connection.connection = None
-                    break
-                if imageData == None:
-                    imageData = dataReceived
-                else:
-                    imageData += dataReceived
-                for i in range(len(dataReceived)):
-                        if dataReceived[i] == 255:
-                            if i != len(dataReceived) - 1:
-                                if dataReceived[i + 1] == 217:
-                                    imageComplete = True
-                                    
-            #print("image captured from: ", connection.MAC)
-                                    
-            if detectionThread.is_alive():
-                detectionThread.join()
+            if captureMode == "request":
+                if connection.connection == None:
+                    continue
+                if not pollScheduler.isDue(connection.MAC):
+                    continue
+                pollScheduler.markPolled(connection.MAC)
+                imageData = requestImage(connection)
+            else:
+                imageData = connection.frameSlot.take()
+                if imageData is None:
+                    continue
+            polled = True
+            nextIndex = index + 1
             
-            if connectionDied:
+            if imageData is None:
                 continue
             
-            if type(imageData) != None:
-                if len(imageData):
-                    image = cv2.imdecode(np.frombuffer(imageData, np.uint8), cv2.IMREAD_UNCHANGED)
-                    if type(image) != type(None):
-                        detectionThread = threading.Thread(target=detectHumans, args=(image, net, connection)) # detectionThread created
-                        detectionThread.start()
+            if len(imageData):
+                # an image the camera already sent doesn't need to be decoded or looked at again
+                result, cacheEntry = connection.frameCache.lookup(imageData)
+                if result is not None:
+                    repeatDetection(connection, result)
+                    continue
+                # door regions are cropped out of the full size image so only cameras without them are decoded smaller
+                targetWidth = inputWidth if connection.MAC not in cameraDoors else None
+                pending.append((connection, decoder.submit(imageData, targetWidth), cacheEntry))
+                busy.add(connection.MAC)
+            startNextDetection()
+        
+        if not polled:
+            time.sleep(0.005) # nothing was due, avoids spinning while waiting for the next camera
             
     if detectionThread.is_alive():
         detectionThread.join()
+    decoder.shutdown()
+    if receiver is not None:
+        receiver.stop()
+    if detectorCascade is not None:
+        frames, escalations = detectorCascade.getStatistics()
+        print("cascade escalated {:.1%} of {} frames: {}".format(detectorCascade.getEscalationRate(), frames, escalations))
 
 
 
@@ -334,7 +833,13 @@ def toggleHandoutThread():
 def toggleWorkThread():
     global workThread
     global workThreadRunning
+    global captureMode
+    global useCascade
+    global useAutotune
     if workThreadRunning == False:
+        captureMode = captureModeVar.get()
+        useCascade = useCascadeVar.get()
+        useAutotune = useAutotuneVar.get()
         workThreadRunning = True
         workThread = threading.Thread(target=work, daemon=True)
         workThread.start()
@@ -349,6 +854,27 @@ def toggleWorkThread():
             print("workThread not running")
         toggleWorker["text"] = "Work Thread: Off"
 
+# UI function, toggles the occupancyThread and updates the UI to show that it is running
+def toggleOccupancyThread():
+    global occupancyThread
+    global occupancyThreadRunning
+    if occupancyThreadRunning == False:
+        occupancyThreadRunning = True
+        if plan is not None:
+            occupancyServer.publishCounts(getRoomCounts(plan))
+        occupancyThread = threading.Thread(target=occupancyServer.run, args=(lambda: occupancyThreadRunning,), daemon=True)
+        occupancyThread.start()
+        toggleOccupancy["text"] = "Occupancy API: On"
+    else:
+        occupancyThreadRunning = False
+        if occupancyThread.is_alive():
+            print("waiting for occupancyThread to join")
+            occupancyThread.join()
+            print("occupancyThread joined")
+        else:
+            print("occupancyThread not running")
+        toggleOccupancy["text"] = "Occupancy API: Off"
+
 # UI function, selects the previous available camera
 def cycleLeft():
     global connections
@@ -371,40 +897,160 @@ def cycleRight():
         iterator = 0
     iteratorText["text"] = "Iterator: " + str(iterator)
 
-# UI function, updates the displayed image for the camera that is selected
+# UI function, updates the displayed image for the camera that is selected, or the mosaic of every camera
+# the canvas is only redrawn when the image has changed
 def refreshImage():
     global connections
     global iterator
-    if len(connections) > 0:
+    global imageView
+    global cameraMosaic
+    global shownImage
+    if not modulesLoaded.is_set() or modelFailed:
+        return
+    if imageView is None:
+        imageView = ms.canvasView(canvas)
+        cameraMosaic = ms.mosaicView(int(canvas["width"]), int(canvas["height"]))
+    
+    if showMosaicVar.get():
+        if shownImage != "mosaic":
+            cameraMosaic.redraw()
+        connectionsLock.acquire()
+        if cameraMosaic.refresh(connections, imageView):
+            shownImage = "mosaic"
+        connectionsLock.release()
+    elif len(connections) > 0:
         connectionsLock.acquire()
         image = connections[iterator].image
         if type(image) != type(None):
-            connections[iterator].PhotoImage = ImageTk.PhotoImage(master=canvas, image=Image.fromarray(image))
+            if shownImage != (connections[iterator].MAC, connections[iterator].imageVersion):
+                imageView.show(image)
+                shownImage = (connections[iterator].MAC, connections[iterator].imageVersion)
             connectionsLock.release()
             MACaddress["text"] = connections[iterator].MAC
-            canvas.create_image(0, 0, image=connections[iterator].PhotoImage, anchor="nw")
+            targetRate, measuredRate = pollScheduler.getRates(connections[iterator].MAC)
+            pollRate["text"] = "Rate: {:.1f} fps (target {:.1f})".format(measuredRate, targetRate)
+            frameSlot = connections[iterator].frameSlot
+            if frameSlot.sequence > 0:
+                pollRate["text"] += "\nLast image used: {} of {} received, {} skipped".format(frameSlot.consumed, frameSlot.sequence, frameSlot.dropped)
+            duplicateRate["text"] = "Repeated images: {:.0%}".format(connections[iterator].frameCache.getHitRate())
         else:
             connectionsLock.release()
 
+# UI function, clicking a camera in the mosaic selects it and goes back to showing just that camera
+def selectFromMosaic(event):
+    global iterator
+    if showMosaicVar.get() and cameraMosaic is not None:
+        index = cameraMosaic.getIndex(event.x, event.y)
+        if index is not None and index < len(connections):
+            iterator = index
+            iteratorText["text"] = "Iterator: " + str(iterator)
+            showMosaicVar.set(False)
+
 # UI function, updates the UI with the current number of connected ESP32-cams
 def updateNumConnections():
     global connections
     numConnections["text"] = "Connections: " + str(len(connections))
 
+# UI function, updates the UI with how much memory the selected camera and all cameras are using
+# adding it up for hundreds of cameras isn't free so it is only done every 2 seconds
+def updateMemoryReport():
+    global lastMemoryReport
+    if time.monotonic() - lastMemoryReport < 2 or not modulesLoaded.is_set() or modelFailed:
+        return
+    lastMemoryReport = time.monotonic()
+    connectionsLock.acquire()
+    usages = [device.getMemoryUsage() for device in connections]
+    trafficDropped = sum(device.trafficDropped for device in connections)
+    connectionsLock.release()
+    if len(usages) == 0:
+        memoryUsage["text"] = ""
+        return
+    total = sum(sum(usage.values()) for usage in usages)
+    selected = sum(usages[min(iterator, len(usages) - 1)].values())
+    memoryUsage["text"] = "Memory: {:.0f} KB, all {} cameras {:.1f} MB".format(selected / 1024, len(usages), total / 1024 / 1024)
+    if trafficDropped > 0:
+        memoryUsage["text"] += "\n" + str(trafficDropped) + " enter/exit events dropped"
+
+# prints what the selected camera and all cameras are using memory for, from the "Memory" label
+def printMemoryReport(event=None):
+    connectionsLock.acquire()
+    usages = [(device.MAC, device.getMemoryUsage(), device.trafficDropped) for device in connections]
+    connectionsLock.release()
+    totals = {}
+    trafficDropped = 0
+    for (MAC, usage, dropped) in usages:
+        print(MAC, " ", ", ".join(part + " " + str(size // 1024) + " KB" for (part, size) in usage.items()), ", ", dropped, " events dropped")
+        for (part, size) in usage.items():
+            totals[part] = totals.get(part, 0) + size
+        trafficDropped += dropped
+    print("all ", len(usages), " cameras: ", ", ".join(part + " " + str(size // 1024) + " KB" for (part, size) in totals.items()), ", ", trafficDropped, " events dropped")
+
+# UI function, updates the UI with how often the detector cascade had to run the full network
+def updateCascadeRate():
+    if detectorCascade is not None:
+        cascadeRate["text"] = "Full network: {:.0%} of frames".format(detectorCascade.getEscalationRate())
+    else:
+        cascadeRate["text"] = ""
+
+# UI function, updates the UI with what the handoutThread has done with the discovery requests it received
+def updateDiscoveryCounters():
+    counters = discoveryService.counters.get()
+    discoveryCounters["text"] = "Discovery: " + str(counters["answered"]) + "/" + str(counters["received"]) + " answered"
+    discoveryCounters["text"] += "\n" + str(counters["coalesced"]) + " repeats, " + str(counters["rateLimited"]) + " limited"
+
+# UI function, updates the UI with how many programs are subscribed to the occupancyServer and what it has sent them
+def updateOccupancyCounters():
+    if not occupancyThreadRunning:
+        occupancyCounters["text"] = ""
+        return
+    counters = occupancyServer.counters.get()
+    occupancyCounters["text"] = "Occupancy API: " + str(counters["subscribers"]) + " subscribers, " + str(counters["messages"]) + " messages"
+    occupancyCounters["text"] += "\n" + str(counters["resyncs"]) + " resyncs, " + str(counters["rejected"]) + " refused"
+
+# returns room name -> number of people in the room
+def getRoomCounts(plan):
+    return dict((room, plan.rooms[room].peopleCount) for room in plan.rooms)
+
 # Reads from a list of instructions in each connection that instructs the floorPlan on the movement of people
+# returns True if anyone moved
+# if the occupancyThread is running everything that happened is published to its subscribers
 def movePeople(plan):
-    global connections
     connectionsLock.acquire()
+    moved = applyTraffic(plan)
+    connectionsLock.release()
+    if moved and occupancyThreadRunning:
+        occupancyServer.publishCounts(getRoomCounts(plan))
+    return moved
+
+# applies and logs the enter/exit events every camera has waiting, returns True if anyone moved
+# connectionsLock must be held, the caller publishes the new counts
+def applyTraffic(plan):
+    moved = False
     for connection in connections:
         for room in plan.rooms:
             if connection.MAC == plan.rooms[room].camera:
                 while len(connection.humanTraffic) > 0:
-                    traffic = connection.humanTraffic.pop(0)
+                    traffic = connection.humanTraffic.popleft()
                     if traffic[0] == "enter":
                         plan.rooms[room].movePerson(traffic[1], True)
                     elif traffic[0] == "exit":
                         plan.rooms[room].movePerson(traffic[1], False)
+                    if checkpoints is not None:
+                        checkpoints.logTraffic(room, traffic[0] == "enter", traffic[1])
+                    if occupancyThreadRunning:
+                        occupancyServer.publishTraffic(room, traffic[0], traffic[1])
+                    moved = True
                 break
+    return moved
+
+# in worker mode, hands the enter and exit events of every camera to the coordinator instead of a local floorPlan
+def forwardTraffic():
+    global connections
+    connectionsLock.acquire()
+    for connection in connections:
+        while len(connection.humanTraffic) > 0:
+            traffic = connection.humanTraffic.popleft()
+            clusterLink.sendTraffic(connection.MAC, traffic[0], traffic[1])
     connectionsLock.release()
 
 # UI function, updates the UI with the current amount of people in each room
@@ -422,11 +1068,13 @@ def quitProgram():
     global listeningThreadRunning
     global handoutThreadRunning
     global workThreadRunning
+    global occupancyThreadRunning
     global connections
     
     listeningThreadRunning = False
     handoutThreadRunning = False
     workThreadRunning = False
+    occupancyThreadRunning = False
     
     if listeningThread.is_alive():
         print("waiting for listeningThread to join")
@@ -443,11 +1091,30 @@ def quitProgram():
         workThread.join()
         print("workThread joined")
     
+    if occupancyThread.is_alive():
+        print("waiting for occupancyThread to join")
+        occupancyThread.join()
+        print("occupancyThread joined")
+    
+    if checkpoints is not None:
+        # a checkpoint that starts a new event log may still be being written, it only takes a moment
+        saved = saveCheckpoint()
+        giveUpTime = time.monotonic() + 5
+        while not saved and time.monotonic() < giveUpTime:
+            time.sleep(0.05)
+            saved = saveCheckpoint()
+        checkpoints.close()
+        if saved:
+            print("checkpoint saved")
+        else:
+            print("failed to save a final checkpoint, the event log will be replayed on the next start")
+    
     print("Closing all connections")
     for connection in connections:
         if connection.connection != None:
             connection.connection[0].close()
     connections.clear()
+    devices.clear()
     
     print("Program finished")
     
@@ -465,6 +1132,11 @@ def getFloorPlan():
         plan = fp.createFloorPlanFromFile(filePath)
         
         if plan is not None:
+            for room in plan.rooms:
+                if plan.rooms[room].camera is not None and plan.rooms[room].doorRegions is not None:
+                    cameraDoors[plan.rooms[room].camera] = plan.rooms[room].doorRegions
+            if clusterLink is None:
+                restoreCheckpoint(filePath)
             for room in plan.rooms:
                 roomPeopleCount.append([tk.Label(statisticsFrame, text=plan.rooms[room].roomName + ": "), tk.Label(statisticsFrame, text="0")])
             
@@ -473,6 +1145,9 @@ def getFloorPlan():
                 room[0].grid(row=roomRow, column=0, sticky="W")
                 room[1].grid(row=roomRow, column=1, sticky="E")
                 roomRow += 1
+            
+            if occupancyThreadRunning:
+                occupancyServer.publishCounts(getRoomCounts(plan))
     else:
         print("floorPlan already created")
     
@@ -500,7 +1175,7 @@ inputButton = tk.Button(topFrame, text="Select", command=getFloorPlan)
 inputButton.grid(row=0, column=2, sticky="W")
 
 
-leftFrame = tk.Frame(UI, width=120, height=480)
+leftFrame = tk.Frame(UI, width=200, height=480)
 leftFrame.grid(row=1, column=0, sticky="N")
 leftFrame.grid_propagate(0)
 
@@ -510,6 +1185,9 @@ leftTopFrame.grid(row=0, column=0, sticky="NESW")
 numConnections = tk.Label(leftTopFrame, text="Connections: " + str(len(connections)))
 numConnections.grid(row=0, column=0, sticky="NESW")
 
+discoveryCounters = tk.Label(leftTopFrame, text="")
+discoveryCounters.grid(row=1, column=0, sticky="NESW")
+
 
 leftMiddleFrame = tk.Frame(leftFrame)
 leftMiddleFrame.grid(row=1, column=0, sticky="NESW")
@@ -523,6 +1201,24 @@ toggleHandouter.grid(row=1, column=0, sticky="NESW")
 toggleWorker = tk.Button(leftMiddleFrame, text="Work Thread: Off", command=toggleWorkThread)
 toggleWorker.grid(row=2, column=0, sticky="NESW")
 
+toggleOccupancy = tk.Button(leftMiddleFrame, text="Occupancy API: Off", command=toggleOccupancyThread)
+toggleOccupancy.grid(row=3, column=0, sticky="NESW")
+
+captureModeVar = tk.StringVar(UI, value=captureMode) # read when the workThread starts
+captureModeMenu = tk.OptionMenu(leftMiddleFrame, captureModeVar, *fs.captureModes)
+captureModeMenu.grid(row=4, column=0, sticky="NESW")
+
+useCascadeVar = tk.BooleanVar(UI, value=useCascade) # read when the workThread starts
+useCascadeBox = tk.Checkbutton(leftMiddleFrame, text="Detector Cascade", variable=useCascadeVar)
+useCascadeBox.grid(row=5, column=0, sticky="W")
+
+cascadeRate = tk.Label(leftMiddleFrame, text="")
+cascadeRate.grid(row=6, column=0, sticky="NESW")
+
+useAutotuneVar = tk.BooleanVar(UI, value=useAutotune) # read when the workThread starts
+useAutotuneBox = tk.Checkbutton(leftMiddleFrame, text="Autotune Network", variable=useAutotuneVar)
+useAutotuneBox.grid(row=7, column=0, sticky="W")
+
 
 leftBottomFrame = tk.Frame(UI)
 leftBottomFrame.grid(row=2, column=0, sticky="S")
@@ -530,14 +1226,28 @@ leftBottomFrame.grid(row=2, column=0, sticky="S")
 MACaddress = tk.Label(leftBottomFrame, text="")
 MACaddress.grid(row=0, column=0, columnspan=2, sticky="NESW")
 
+pollRate = tk.Label(leftBottomFrame, text="")
+pollRate.grid(row=1, column=0, columnspan=2, sticky="NESW")
+
+duplicateRate = tk.Label(leftBottomFrame, text="")
+duplicateRate.grid(row=2, column=0, columnspan=2, sticky="NESW")
+
+memoryUsage = tk.Label(leftBottomFrame, text="")
+memoryUsage.grid(row=3, column=0, columnspan=2, sticky="NESW")
+memoryUsage.bind("<Button-1>", printMemoryReport) # clicking it prints every camera's memory use
+
 iteratorText = tk.Label(leftBottomFrame, text="Iterator: " + str(iterator))
-iteratorText.grid(row=1, column=0, columnspan=2, sticky="NESW")
+iteratorText.grid(row=4, column=0, columnspan=2, sticky="NESW")
 
 leftButton = tk.Button(leftBottomFrame, text=" < ", command=cycleLeft)
-leftButton.grid(row=2, column=0, sticky="E")
+leftButton.grid(row=5, column=0, sticky="E")
         
 rightButton = tk.Button(leftBottomFrame, text=" > ", command=cycleRight)
-rightButton.grid(row=2, column=1, sticky="W")
+rightButton.grid(row=5, column=1, sticky="W")
+
+showMosaicVar = tk.BooleanVar(UI, value=False)
+showMosaicBox = tk.Checkbutton(leftBottomFrame, text="Mosaic View", variable=showMosaicVar)
+showMosaicBox.grid(row=6, column=0, columnspan=2)
 
 
 rightFrame = tk.Frame(UI, width=640, height=480)
@@ -545,10 +1255,11 @@ rightFrame.grid(row=1, column=1)
 
 canvas = tk.Canvas(rightFrame, width=640, height=480)
 canvas.grid(row=0, column=0)
+canvas.bind("<Button-1>", selectFromMosaic)
 
 
 statisticsFrame = tk.Frame(leftMiddleFrame)
-statisticsFrame.grid(row=3, column=0)
+statisticsFrame.grid(row=8, column=0)
 
 totalPeople = tk.Label(statisticsFrame, text="Total people: ")
 totalPeople.grid(row=0, column=0, sticky="W")
@@ -556,13 +1267,42 @@ totalPeople.grid(row=0, column=0, sticky="W")
 totalPeopleCount = tk.Label(statisticsFrame, text="0")
 totalPeopleCount.grid(row=0, column=1, sticky="E")
 
+modelStatusText = tk.Label(leftTopFrame, text=modelStatus)
+modelStatusText.grid(row=2, column=0, sticky="NESW")
+
+clusterStatus = tk.Label(leftTopFrame, text="")
+clusterStatus.grid(row=3, column=0, sticky="NESW")
+
+occupancyCounters = tk.Label(leftTopFrame, text="")
+occupancyCounters.grid(row=4, column=0, sticky="NESW")
+
+modelThread = threading.Thread(target=loadModel, daemon=True)
+modelThread.start()
+
 running = True
+
+if arguments.worker is not None:
+    clusterLink = cl.workerLink(arguments.name, cl.parseAddress(arguments.worker, cl.coordinatorPort), cameraPort, arguments.advertise, onAssign=clusterAssigned)
+    clusterThread = threading.Thread(target=clusterLink.run, args=(lambda: running,), daemon=True)
+    clusterThread.start()
+
 while running:
+    modelStatusText["text"] = modelStatus
     updateNumConnections()
+    updateDiscoveryCounters()
+    updateOccupancyCounters()
+    updateCascadeRate()
+    updateMemoryReport()
     refreshImage()
-    if plan is not None:
-        movePeople(plan)
+    if clusterLink is not None:
+        clusterStatus["text"] = clusterLink.getStatus()
+        forwardTraffic()
+    elif plan is not None:
+        moved = movePeople(plan)
         printPeopleCount(plan, roomPeopleCount)
+        # the tracks in a checkpoint have to match the counts, otherwise a restart would count people who moved since the last one twice
+        if checkpoints is not None and (moved or checkpoints.isDue()):
+            saveCheckpoint()
     UI.update()
 
 
@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+"""
+Works out the fastest way to run the network on this computer
+
+every backend/target pair OpenCV has available is tried, CPU targets are also tried with different numbers of threads,
+and each of those is tried with several input widths, a few forward passes are timed on a synthetic 640x480 image for each one
+the largest input width that meets latencyTarget is picked (bigger inputs find people more reliably),
+along with the fastest backend, target and thread count for that width
+if nothing meets latencyTarget the fastest configuration overall is used
+
+results are saved to autotune.json under this computer's name, the OpenCV version and the network,
+so calibration only happens the first time and whenever one of those changes, delete the file to calibrate again
+
+@author: Zac
+"""
+import os
+import json
+import time
+import socket
+import numpy as np
+import cv2
+
+import detector as dt
+
+settingsFile = "autotune.json"
+inputWidths = [320, 416, 512, 640] # 640 is the widest image the cameras send
+
+# the settings used when autotuning is off, these are what the workThread has always used
+defaultSettings = {"backend": cv2.dnn.DNN_BACKEND_OPENCV, "target": cv2.dnn.DNN_TARGET_OPENCL, "threads": None, "inputWidth": None}
+
+# returns the name the settings for this computer, OpenCV version and network are saved under
+def getSettingsKey(cfg):
+    return socket.gethostname() + " | OpenCV " + cv2.__version__ + " | " + os.path.basename(cfg)
+
+# returns every (backend, target) pair that OpenCV says it can use
+def getBackends():
+    try:
+        backends = [(int(backend), int(target)) for (backend, target) in cv2.dnn.getAvailableBackends()]
+    except:
+        backends = []
+    if len(backends) == 0:
+        backends = [(cv2.dnn.DNN_BACKEND_OPENCV, cv2.dnn.DNN_TARGET_CPU)]
+    return backends
+
+# returns the thread counts worth trying on a CPU target
+def getThreadCounts():
+    cores = os.cpu_count() or 1
+    return sorted(set([1, max(1, cores // 2), cores]))
+
+# applies settings to one or more networks
+def applySettings(settings, *nets):
+    if settings["threads"] is not None:
+        cv2.setNumThreads(settings["threads"])
+    for net in nets:
+        net.setPreferableBackend(settings["backend"])
+        net.setPreferableTarget(settings["target"])
+
+# returns the median time in seconds of passes forward passes through net, the first pass is not counted since it sets the network up
+def timeForwardPasses(net, image, inputWidth, passes):
+    layerNames = dt.getOutputLayerNames(net)
+    blob = cv2.dnn.blobFromImage(image, 1/255.0, dt.getBlobSize(image.shape[1], image.shape[0], inputWidth), swapRB=True, crop=False)
+    net.setInput(blob)
+    net.forward(layerNames)
+    times = []
+    for i in range(passes):
+        startTime = time.monotonic()
+        net.setInput(blob)
+        net.forward(layerNames)
+        times.append(time.monotonic() - startTime)
+    return sorted(times)[len(times) // 2]
+
+# times every configuration and returns the settings to use
+# latencyTarget = seconds a single forward pass should take at most
+def calibrate(net, latencyTarget, passes=3):
+    image = np.random.randint(0, 256, (480, 640, 3), dtype=np.uint8)
+    results = [] # (time, settings)
+    # targets that aren't the CPU are timed with OpenCV's own thread count, not whatever the last CPU run left it at
+    defaultThreads = cv2.getNumThreads()
+    for (backend, target) in getBackends():
+        threadCounts = getThreadCounts() if target == cv2.dnn.DNN_TARGET_CPU else [defaultThreads]
+        failed = False
+        for threads in threadCounts:
+            for inputWidth in inputWidths:
+                settings = {"backend": backend, "target": target, "threads": threads, "inputWidth": inputWidth}
+                try:
+                    applySettings(settings, net)
+                    latency = timeForwardPasses(net, image, inputWidth, passes)
+                except:
+                    print("autotune: backend ", backend, " target ", target, " failed")
+                    failed = True
+                    break
+                print("autotune: backend ", backend, " target ", target, " threads ", threads, " width ", inputWidth, " took {:.1f} ms".format(latency * 1000))
+                results.append((latency, settings))
+            if failed:
+                break # the same backend/target will fail for the other thread counts and widths too
+
+    if len(results) == 0:
+        return dict(defaultSettings)
+    meetsTarget = [result for result in results if result[0] <= latencyTarget]
+    if len(meetsTarget) > 0:
+        widest = max(result[1]["inputWidth"] for result in meetsTarget)
+        latency, settings = min([result for result in meetsTarget if result[1]["inputWidth"] == widest], key=lambda result: result[0])
+    else:
+        latency, settings = min(results, key=lambda result: result[0])
+        print("autotune: nothing met the latency target of {:.0f} ms, using the fastest configuration".format(latencyTarget * 1000))
+    settings["latency"] = latency
+    return settings
+
+# returns the settings saved for this computer and network, or None if there aren't any
+def loadSettings(cfg):
+    try:
+        with open(settingsFile, "r") as f:
+            return json.load(f).get(getSettingsKey(cfg))
+    except:
+        return None
+
+# saves settings for this computer and network, settings for other computers in the file are kept
+def saveSettings(cfg, settings):
+    allSettings = {}
+    try:
+        with open(settingsFile, "r") as f:
+            allSettings = json.load(f)
+    except:
+        pass
+    allSettings[getSettingsKey(cfg)] = settings
+    try:
+        with open(settingsFile, "w") as f:
+            json.dump(allSettings, f, indent=4)
+    except:
+        print("autotune: failed to save settings to " + settingsFile)
+
+# returns the saved settings for this computer and network, calibrating and saving them first if there aren't any
+def loadOrCalibrate(net, cfg, latencyTarget=0.25):
+    settings = loadSettings(cfg)
+    if settings is not None:
+        print("autotune: using saved settings ", settings)
+        return settings
+    print("autotune: calibrating, this only happens once per computer")
+    settings = calibrate(net, latencyTarget)
+    print("autotune: picked ", settings)
+    saveSettings(cfg, settings)
+    return settings
@@ -26,11 +26,18 @@ char pass[] = "";
 
 int status = WL_IDLE_STATUS;
 IPAddress server(192,168,1,100);
-int port = 25425;
+const int defaultPort = 25425;
+int port = defaultPort;
 
 WiFiClient client;
 String mac;
 
+// push mode, the server sends "stream <fps>\n" and this device sends images on its own at that rate
+bool streaming = false;
+unsigned long streamInterval = 0; // milliseconds between images while streaming
+unsigned long lastImageSent = 0;
+String command; // partially received command from the server
+
 WiFiUDP udp;
 IPAddress broadcastIP(192,168,1,255); // this may need to be changed depending on how the WiFi network is configured
 
@@ -72,6 +79,7 @@ void findServer()
       server[1] = one;
       server[2] = two;
       server[3] = three;
+      port = defaultPort;
     }
   }
   delay(2000);
@@ -97,6 +105,117 @@ void connectToServer()
   delay(1000);
 }
 
+/*
+ * Changes the frame size and JPEG quality, sizes bigger than the 640x480 the camera was initialized with are not allowed.
+ * Lower quality numbers mean better quality and bigger images.
+ */
+void setProfile(int width, int height, int quality)
+{
+  framesize_t frameSize;
+  if (width == 160 && height == 120)
+    frameSize = FRAMESIZE_QQVGA;
+  else if (width == 240 && height == 176)
+    frameSize = FRAMESIZE_HQVGA;
+  else if (width == 320 && height == 240)
+    frameSize = FRAMESIZE_QVGA;
+  else if (width == 400 && height == 296)
+    frameSize = FRAMESIZE_CIF;
+  else if (width == 640 && height == 480)
+    frameSize = FRAMESIZE_VGA;
+  else
+  {
+    Serial.println("Unsupported frame size requested");
+    return;
+  }
+  if (quality < 2 || quality > 63)
+  {
+    Serial.println("Unsupported JPEG quality requested");
+    return;
+  }
+
+  sensor_t * sensor = esp_camera_sensor_get();
+  sensor -> set_framesize(sensor, frameSize);
+  sensor -> set_quality(sensor, quality);
+  Serial.print("Profile changed to ");
+  Serial.print(width);
+  Serial.print("x");
+  Serial.print(height);
+  Serial.print(" quality ");
+  Serial.println(quality);
+}
+
+/*
+ * Reads any commands the server has sent.
+ * "send image" asks for a single image, older servers only ever send this command and don't end it with a newline.
+ * "stream <fps>\n" makes this device send images at the given rate without being asked, "stream 0\n" stops it.
+ * "profile <width>x<height> <quality>\n" changes the frame size and JPEG quality.
+ * "server <IP> <port>\n" means another server owns this device, it disconnects and connects to that one instead.
+ * Returns true if the server asked for an image.
+ */
+bool readCommands()
+{
+  bool imageRequested = false;
+  while (client.available())
+  {
+    char c = (char)client.read();
+    if (c == '\n')
+    {
+      command.trim();
+      if (command.startsWith("stream "))
+      {
+        float fps = command.substring(7).toFloat();
+        if (fps > 0)
+        {
+          streaming = true;
+          streamInterval = (unsigned long)(1000.0 / fps);
+        }
+        else
+        {
+          streaming = false;
+        }
+      }
+      else if (command.startsWith("profile "))
+      {
+        int x = command.indexOf('x', 8);
+        int space = command.indexOf(' ', 8);
+        if (x > 0 && space > x)
+        {
+          setProfile(command.substring(8, x).toInt(), command.substring(x + 1, space).toInt(), command.substring(space + 1).toInt());
+        }
+      }
+      else if (command.startsWith("server "))
+      {
+        int space = command.indexOf(' ', 7);
+        IPAddress newServer;
+        if (space > 7 && newServer.fromString(command.substring(7, space)))
+        {
+          Serial.print("Moving to server ");
+          Serial.println(command.substring(7));
+          server = newServer;
+          port = command.substring(space + 1).toInt();
+          command = "";
+          client.stop(); // loop() connects to the new server
+          return false;
+        }
+      }
+      command = "";
+      continue;
+    }
+    command += c;
+    if (command.endsWith("send image"))
+    {
+      imageRequested = true;
+      command = "";
+    }
+    else if (command.length() > 64)
+    {
+      // something went wrong, throw it away rather than filling up memory
+      command = "";
+    }
+  }
+  return imageRequested;
+}
+
 /*
  * Prepares the ESP32 by connecting to wifi and initializing the camera
  */
@@ -147,7 +266,11 @@ void setup()
   config.pixel_format = PIXFORMAT_JPEG;
   config.frame_size = FRAMESIZE_VGA;
   config.jpeg_quality = 2; //lower is higher quality
-  config.fb_count = 1;
+  // two frame buffers in PSRAM that the driver keeps refilling, so esp_camera_fb_get() returns the newest frame
+  // instead of one that was captured whenever the last image was sent
+  config.fb_count = 2;
+  config.fb_location = CAMERA_FB_IN_PSRAM;
+  config.grab_mode = CAMERA_GRAB_LATEST;
   
   esp_err_t err = esp_camera_init(&config);
   if (err != ESP_OK)
@@ -188,8 +311,8 @@ void setup()
 /*
  * Main loop, this runs continuously.
  * First it connects to the server.
- * Second it captures an image.
- * Third it checks if the server wants an image.
+ * Second it checks if the server wants an image, either because it asked for one or because it is time for the next streamed image.
+ * Third it captures an image.
  * Fourth it sends the image to the server.
  * Repeat forever.
  */
@@ -197,18 +320,22 @@ void loop()
 {
   if (!client.connected())
   {
+    streaming = false;
+    command = "";
     connectToServer();
   }
 
-  //Capture Image
-  camera_fb_t * frameBuffer = esp_camera_fb_get();
+  bool sendImage = readCommands();
+  if (streaming && millis() - lastImageSent >= streamInterval)
+  {
+    sendImage = true;
+  }
   
   //Serial.println("Waiting for image request");
-  if (client.available())
+  if (sendImage)
   {
-    client.flush();
-    
     // capture an image
+    camera_fb_t * frameBuffer = esp_camera_fb_get();
     if (!frameBuffer)
     {
       Serial.println("Failed to capture image");
@@ -220,8 +347,8 @@ void loop()
       // send the image to the server
       Serial.println("Sending image to server");
       client.write(frameBuffer->buf, frameBuffer->len);
-      //esp_camera_fb_return(frameBuffer);
+      lastImageSent = millis();
+      esp_camera_fb_return(frameBuffer);
     }
   }
-  esp_camera_fb_return(frameBuffer);
 }
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+"""
+Picks the capture profile (frame size and JPEG quality) each ESP32-cam should use
+
+the server tells a camera to change profile with "profile <width>x<height> <quality>\n"
+lower JPEG quality numbers mean higher quality and bigger images, the firmware starts out at 640x480 with quality 2
+
+each camera gets a profileController, after every detection it is told how confident the network was
+while the weakest detection in each frame stays comfortably above confidenceThreshold it steps down to a cheaper profile,
+if confidence drops or people that are being tracked stop being detected it steps back up
+
+@author: Zac
+"""
+import time
+
+# (width, height, jpeg quality), cheapest first
+# only sizes the firmware knows about may be used, and nothing bigger than 640x480 since that is what the camera allocates its buffer for
+profiles = [
+    (320, 240, 20),
+    (320, 240, 12),
+    (400, 296, 12),
+    (640, 480, 12),
+    (640, 480, 6),
+    (640, 480, 2),
+]
+
+# returns the command that tells a camera to use profile
+def profileCommand(profile):
+    return "profile " + str(profile[0]) + "x" + str(profile[1]) + " " + str(profile[2])
+
+# decides which profile a single camera should use
+# confidenceThreshold = the average confidence of the weakest detection in each frame has to stay above this
+# stepDownMargin = how far above confidenceThreshold the confidence has to be before a cheaper profile is tried
+# window = number of frames with people in them that are looked at before making a decision
+# holdTime = seconds to wait before trying a cheaper profile again after one turned out to be too cheap
+# people walking out of view also count as misses for a few frames, so a few misses don't stop it stepping down
+class profileController:
+    def __init__(self, confidenceThreshold=0.7, stepDownMargin=0.1, window=20, holdTime=60.0):
+        self.confidenceThreshold = confidenceThreshold
+        self.stepDownMargin = stepDownMargin
+        self.window = window
+        self.holdTime = holdTime
+        self.index = len(profiles) - 1 # starts with the profile the firmware starts with
+        self.weakest = [] # confidence of the weakest detection in each recent frame
+        self.misses = 0 # recent frames where fewer people were detected than were being tracked
+        self.holdUntil = {} # profile index -> time before which it won't be tried again
+
+    def getProfile(self):
+        return profiles[self.index]
+
+    # forgets the recent frames, done whenever the profile changes since they were taken with the old one
+    def reset(self):
+        self.weakest = []
+        self.misses = 0
+
+    # tells the controller about the detections in a frame
+    # confidences = confidence of every person detected, missed = True if fewer people were detected than were being tracked
+    # returns the new profile if the camera should change profile, otherwise None
+    def report(self, confidences, missed):
+        if missed:
+            self.misses += 1
+        if len(confidences) > 0:
+            self.weakest.append(min(confidences))
+        elif not missed:
+            return None # nobody in view, nothing to learn from this frame
+
+        if len(self.weakest) + self.misses < self.window:
+            return None
+
+        average = sum(self.weakest) / len(self.weakest) if len(self.weakest) > 0 else 0.0
+        missRatio = self.misses / (len(self.weakest) + self.misses)
+        now = time.monotonic()
+        change = 0
+        if average < self.confidenceThreshold or missRatio > 0.3:
+            if self.index < len(profiles) - 1:
+                self.holdUntil[self.index] = now + self.holdTime # this profile was too cheap, don't come straight back to it
+                change = 1
+        elif average >= self.confidenceThreshold + self.stepDownMargin and missRatio < 0.25:
+            if self.index > 0 and self.holdUntil.get(self.index - 1, 0) <= now:
+                change = -1
+        self.reset()
+        if change == 0:
+            return None
+        self.index += change
+        return profiles[self.index]
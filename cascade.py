@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+"""
+Two tier detector, a cheap network looks at every frame and the full YOLOv4 network is only run when it is needed
+
+the full network is run when:
+    the cheap network found something it isn't sure about (a confidence between uncertainLow and uncertainHigh)
+    the cheap network counts a different number of people than were found in the camera's previous frame
+    the tracker failed to match everyone in the camera's previous frame
+    the full network hasn't looked at the camera for maxCheapFrames frames
+
+running this file replays recorded footage through both the cascade and the full network and reports how often
+the cascade escalated and how far its person counts were from the full network's:
+    python cascade.py footage.mp4
+    python cascade.py folder_of_jpgs
+
+@author: Zac
+"""
+import os
+import time
+import threading
+import argparse
+import cv2
+
+import detector as dt
+
+# reasons the full network was run, in the order they are checked
+escalationReasons = ["uncertain", "countChanged", "trackerFailed", "refresh"]
+
+# runs fastNet on every frame and fullNet only when it has to
+# fastNet and fullNet are cv2.dnn networks, typically YOLOv4-tiny and YOLOv4
+# maxInputWidth = the widest input either network is given, see autotune.py
+class detectorCascade:
+    def __init__(self, fastNet, fullNet, uncertainLow=0.3, uncertainHigh=0.7, maxCheapFrames=30, maxInputWidth=None):
+        self.fastNet = fastNet
+        self.fullNet = fullNet
+        self.maxInputWidth = maxInputWidth
+        self.fastLayerNames = dt.getOutputLayerNames(fastNet)
+        self.fullLayerNames = dt.getOutputLayerNames(fullNet)
+        self.uncertainLow = uncertainLow
+        self.uncertainHigh = uncertainHigh
+        self.maxCheapFrames = maxCheapFrames
+        self.cameras = {} # MAC -> [people fastNet found in the previous frame, frames since the full network was run]
+        self.lock = threading.Lock()
+        self.frames = 0
+        self.escalations = dict((reason, 0) for reason in escalationReasons)
+
+    # returns the reason the full network has to look at this frame, or None if the cheap network's answer can be used
+    def getEscalationReason(self, MAC, confidences, trackerFailed):
+        previousCount, cheapFrames = self.cameras.get(MAC, [None, self.maxCheapFrames])
+        for confidence in confidences:
+            if confidence < self.uncertainHigh:
+                return "uncertain"
+        if previousCount is None or len(confidences) != previousCount:
+            return "countChanged"
+        if trackerFailed:
+            return "trackerFailed"
+        if cheapFrames >= self.maxCheapFrames:
+            return "refresh"
+        return None
+
+    # same as detector.detectPeople, MAC identifies the camera the image came from
+    # trackerFailed = True if the tracker couldn't match everyone in this camera's previous frame
+    # returns (boxes, confidences, reason), reason is why the full network was run or None if it wasn't
+    def detect(self, MAC, image, regions=None, trackerFailed=False):
+        boxes, confidences = dt.detectPeople(self.fastNet, image, regions, self.fastLayerNames, self.uncertainLow, self.maxInputWidth)
+        # fastNet's count is kept rather than fullNet's so a person fastNet always misses doesn't look like a change every frame
+        cheapCount = len(confidences)
+        with self.lock:
+            reason = self.getEscalationReason(MAC, confidences, trackerFailed)
+        if reason is not None:
+            boxes, confidences = dt.detectPeople(self.fullNet, image, regions, self.fullLayerNames, maxInputWidth=self.maxInputWidth)
+        with self.lock:
+            self.frames += 1
+            if reason is None:
+                self.cameras[MAC][1] += 1
+            else:
+                self.escalations[reason] += 1
+                self.cameras[MAC] = [cheapCount, 0]
+        return (boxes, confidences, reason)
+
+    # returns the fraction of frames the full network was run on
+    def getEscalationRate(self):
+        with self.lock:
+            if self.frames == 0:
+                return 0.0
+            return sum(self.escalations.values()) / self.frames
+
+    # returns a copy of the number of frames, and the number of escalations for each reason
+    def getStatistics(self):
+        with self.lock:
+            return (self.frames, dict(self.escalations))
+
+# creates a network for replaying footage, it runs on the CPU so results don't depend on the graphics card
+def loadNetwork(cfg, weights):
+    net = cv2.dnn.readNetFromDarknet(cfg, weights)
+    net.setPreferableBackend(cv2.dnn.DNN_BACKEND_OPENCV)
+    net.setPreferableTarget(cv2.dnn.DNN_TARGET_CPU)
+    return net
+
+# yields every frame of a video file or every image in a folder, in order
+def readFootage(path):
+    if os.path.isdir(path):
+        for fileName in sorted(os.listdir(path)):
+            if fileName.lower().endswith((".jpg", ".jpeg", ".png")):
+                image = cv2.imread(os.path.join(path, fileName))
+                if image is not None:
+                    yield image
+        return
+    video = cv2.VideoCapture(path)
+    while True:
+        success, image = video.read()
+        if not success:
+            break
+        yield image
+    video.release()
+
+# runs every frame of the footage through the full network and the cascade and prints how they compare
+# the replay has no tracker so a change in the cascade's count is the only thing standing in for a tracker failure
+def replay(path, cascade):
+    countDifference = 0
+    framesDifferent = 0
+    fullTime = 0.0
+    cascadeTime = 0.0
+    frames = 0
+    for image in readFootage(path):
+        startTime = time.monotonic()
+        fullBoxes, fullConfidences = dt.detectPeople(cascade.fullNet, image, None, cascade.fullLayerNames)
+        fullTime += time.monotonic() - startTime
+
+        startTime = time.monotonic()
+        boxes, confidences, reason = cascade.detect("replay", image)
+        cascadeTime += time.monotonic() - startTime
+
+        frames += 1
+        countDifference += abs(len(boxes) - len(fullBoxes))
+        if len(boxes) != len(fullBoxes):
+            framesDifferent += 1
+
+    if frames == 0:
+        print("no frames found in " + path)
+        return
+    total, escalations = cascade.getStatistics()
+    print("frames: " + str(frames))
+    print("escalation rate: {:.1%}".format(cascade.getEscalationRate()))
+    for reason in escalationReasons:
+        print("    " + reason + ": " + str(escalations[reason]))
+    print("frames with a different person count than the full network: {} ({:.1%})".format(framesDifferent, framesDifferent / frames))
+    print("average person count difference: {:.3f}".format(countDifference / frames))
+    print("full network: {:.1f} ms per frame, cascade: {:.1f} ms per frame".format(fullTime / frames * 1000, cascadeTime / frames * 1000))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compares the detector cascade against the full network on recorded footage")
+    parser.add_argument("footage", help="video file or folder of images")
+    parser.add_argument("--fast-cfg", default="YOLO/yolov4-tiny.cfg")
+    parser.add_argument("--fast-weights", default="YOLO/yolov4-tiny.weights")
+    parser.add_argument("--full-cfg", default="YOLO/yolov4.cfg")
+    parser.add_argument("--full-weights", default="YOLO/yolov4.weights")
+    args = parser.parse_args()
+
+    fullNet = loadNetwork(args.full_cfg, args.full_weights)
+    fastNet = loadNetwork(args.fast_cfg, args.fast_weights)
+    replay(args.footage, detectorCascade(fastNet, fullNet))
@@ -0,0 +1,300 @@
+# -*- coding: utf-8 -*-
+"""
+Saves the room counts and every camera's tracked people so a restarted server carries on where it left off
+
+every enter/exit applied to the floorPlan is appended to an event log ("name.events" next to "name.floorplan")
+and a checkpoint ("name.checkpoint") is written every interval seconds and whenever someone enters or exits, with:
+    the number of people in every room
+    the people every camera's tracker is following
+    how far into the event log the checkpoint goes
+on restart the checkpoint is loaded and only the events logged after it are replayed
+
+checkpoint file, all numbers little endian:
+    "HTCP", version (H), epoch (Q), log offset (Q), time (d)
+    rooms (I), each: name length (H), name (utf-8), people (I)
+    cameras (I), each: MAC length (H), MAC, next object ID (I), objects (H),
+        each object: ID (I), x (i), y (i), frames disappeared (H), has origin (B), origin x (i), origin y (i)
+    CRC32 of everything before it (I)
+event log: "HTEV", epoch (Q), then each event: time (d), enter (B), door (B), room name length (H), room name
+
+the checkpoint is written to a temporary file and renamed over the old one so a crash never leaves half a checkpoint behind,
+the writing happens on its own thread so the UI only has to gather the numbers
+once the event log is bigger than maxLogBytes a checkpoint starts a new log with a new epoch,
+a checkpoint only replays a log with the same epoch so an old log is never replayed on top of a newer checkpoint
+
+@author: Zac
+"""
+import os
+import time
+import zlib
+import struct
+import threading
+
+version = 1
+doors = ["Left", "Middle", "Right"]
+checkpointHeader = struct.Struct("<4sHQQd")
+logHeader = struct.Struct("<4sQ")
+eventRecord = struct.Struct("<dBBH")
+objectRecord = struct.Struct("<IiiHBii")
+
+# turns the state into the bytes of a checkpoint file
+# counts = room name -> people, cameras = MAC -> (next object ID, [(ID, x, y, frames disappeared, origin or None)])
+def encodeCheckpoint(epoch, offset, counts, cameras):
+    parts = [checkpointHeader.pack(b"HTCP", version, epoch, offset, time.time()), struct.pack("<I", len(counts))]
+    for (room, people) in counts.items():
+        name = room.encode()
+        parts.append(struct.pack("<H", len(name)) + name + struct.pack("<I", people))
+    parts.append(struct.pack("<I", len(cameras)))
+    for (MAC, (nextObjectID, objects)) in cameras.items():
+        name = MAC.encode()
+        parts.append(struct.pack("<H", len(name)) + name + struct.pack("<IH", nextObjectID, len(objects)))
+        for (objectID, x, y, disappeared, origin) in objects:
+            originX, originY = origin if origin is not None else (0, 0)
+            parts.append(objectRecord.pack(objectID, int(x), int(y), min(disappeared, 65535), origin is not None, int(originX), int(originY)))
+    data = b"".join(parts)
+    return data + struct.pack("<I", zlib.crc32(data))
+
+# reads the bytes of a checkpoint file, returns None if they aren't a complete checkpoint
+# returns {"epoch", "offset", "time", "counts", "cameras"} in the same form encodeCheckpoint takes them
+def decodeCheckpoint(data):
+    if len(data) < checkpointHeader.size + 4 or struct.unpack("<I", data[-4:])[0] != zlib.crc32(data[:-4]):
+        return None
+    magic, fileVersion, epoch, offset, savedTime = checkpointHeader.unpack_from(data, 0)
+    if magic != b"HTCP" or fileVersion != version:
+        return None
+    position = checkpointHeader.size
+
+    def readName():
+        nonlocal position
+        length = struct.unpack_from("<H", data, position)[0]
+        name = data[position + 2:position + 2 + length].decode()
+        position += 2 + length
+        return name
+
+    counts = {}
+    roomCount = struct.unpack_from("<I", data, position)[0]
+    position += 4
+    for i in range(roomCount):
+        room = readName()
+        counts[room] = struct.unpack_from("<I", data, position)[0]
+        position += 4
+    cameras = {}
+    cameraCount = struct.unpack_from("<I", data, position)[0]
+    position += 4
+    for i in range(cameraCount):
+        MAC = readName()
+        nextObjectID, objectCount = struct.unpack_from("<IH", data, position)
+        position += 6
+        objects = []
+        for j in range(objectCount):
+            objectID, x, y, disappeared, hasOrigin, originX, originY = objectRecord.unpack_from(data, position)
+            position += objectRecord.size
+            objects.append((objectID, x, y, disappeared, (originX, originY) if hasOrigin else None))
+        cameras[MAC] = (nextObjectID, objects)
+    return {"epoch": epoch, "offset": offset, "time": savedTime, "counts": counts, "cameras": cameras}
+
+# reads the events in a log file from offset on
+# returns (epoch, [(time, room, enter, door)], offset of the end of the last complete event), epoch is None if there is no log
+def readEvents(fileName, offset=None):
+    try:
+        with open(fileName, "rb") as f:
+            data = f.read()
+    except OSError:
+        return (None, [], 0)
+    if len(data) < logHeader.size:
+        return (None, [], 0)
+    magic, epoch = logHeader.unpack_from(data, 0)
+    if magic != b"HTEV":
+        return (None, [], 0)
+    position = min(max(offset or 0, logHeader.size), len(data))
+    events = []
+    while position + eventRecord.size <= len(data):
+        eventTime, enter, door, length = eventRecord.unpack_from(data, position)
+        end = position + eventRecord.size + length
+        if end > len(data) or door >= len(doors):
+            break # the server stopped half way through writing this event
+        events.append((eventTime, data[position + eventRecord.size:end].decode(), bool(enter), doors[door]))
+        position = end
+    return (epoch, events, position)
+
+# the event log, events are appended by the thread that applies them to the floorPlan
+class eventLog:
+    def __init__(self, fileName):
+        self.fileName = fileName
+        self.lock = threading.Lock()
+        self.file = None
+        self.epoch = None
+
+    # carries on appending to an existing log at offset, anything after offset is a half written event and is cut off
+    def resume(self, epoch, offset):
+        with self.lock:
+            self.file = open(self.fileName, "r+b")
+            self.file.truncate(offset)
+            self.file.seek(offset)
+            self.epoch = epoch
+
+    # starts a new, empty log
+    def start(self, epoch):
+        with self.lock:
+            self.replace(epoch, b"")
+
+    # replaces the log with a new one holding tail, the lock must be held
+    def replace(self, epoch, tail):
+        if self.file is not None:
+            self.file.close()
+        temporary = self.fileName + ".tmp"
+        with open(temporary, "wb") as f:
+            f.write(logHeader.pack(b"HTEV", epoch) + tail)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary, self.fileName)
+        self.file = open(self.fileName, "r+b")
+        self.file.seek(0, os.SEEK_END)
+        self.epoch = epoch
+
+    # appends an event, it is flushed straight away so it survives the program crashing
+    def append(self, room, enter, door):
+        name = room.encode()
+        with self.lock:
+            self.file.write(eventRecord.pack(time.time(), enter, doors.index(door), len(name)) + name)
+            self.file.flush()
+
+    # returns (epoch, offset of the end of the log)
+    def getPosition(self):
+        with self.lock:
+            return (self.epoch, self.file.tell())
+
+    # starts a new log with a new epoch, keeping the events logged after offset
+    def rotate(self, epoch, offset):
+        with self.lock:
+            self.file.seek(offset)
+            tail = self.file.read()
+            self.replace(epoch, tail)
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+# writes checkpoints for the floorPlan in baseName.floorplan and keeps its event log
+# interval = seconds between checkpoints
+# maxLogBytes = size the event log can grow to before a checkpoint starts a new one
+# maxTrackAge = tracks in a checkpoint older than this many seconds aren't restored, the people will have moved on by then
+class checkpointer:
+    def __init__(self, baseName, interval=5.0, maxLogBytes=1 << 20, maxTrackAge=60.0):
+        self.checkpointFile = baseName + ".checkpoint"
+        self.log = eventLog(baseName + ".events")
+        self.interval = interval
+        self.maxLogBytes = maxLogBytes
+        self.maxTrackAge = maxTrackAge
+        self.lastSaved = time.monotonic()
+        self.condition = threading.Condition()
+        self.pending = None # (checkpoint bytes, epoch, offset, rotate) waiting for the writer thread
+        self.writing = False
+        self.rotating = False # True from when a checkpoint that starts a new log is handed over until the new log is in use
+        self.running = True
+        self.writer = threading.Thread(target=self.write, daemon=True)
+
+    # loads the checkpoint and the events logged after it, then opens the event log so new events can be logged
+    # returns (counts, cameras, events), cameras is empty if the checkpoint is too old for its tracks to be any use
+    # counts = room name -> people, cameras = MAC -> (next object ID, objects), events = [(time, room, enter, door)] to replay in order
+    def restore(self):
+        state = None
+        try:
+            with open(self.checkpointFile, "rb") as f:
+                state = decodeCheckpoint(f.read())
+            if state is None:
+                print("checkpoint: ", self.checkpointFile, " is damaged, ignoring it")
+        except OSError:
+            pass
+
+        logEpoch, events, end = readEvents(self.log.fileName, state["offset"] if state is not None else None)
+        if state is not None and logEpoch != state["epoch"]:
+            events = [] # the log is from before the checkpoint's epoch, everything in it is already in the checkpoint
+        if logEpoch is not None and (state is None or logEpoch == state["epoch"]):
+            self.log.resume(logEpoch, end)
+        else:
+            self.log.start(self.newEpoch(state))
+
+        if state is None:
+            self.writer.start()
+            return ({}, {}, events)
+        cameras = state["cameras"]
+        if time.time() - state["time"] > self.maxTrackAge:
+            cameras = {}
+        self.writer.start()
+        return (state["counts"], cameras, events)
+
+    def newEpoch(self, state=None):
+        epoch = int(time.time() * 1000)
+        if state is not None and epoch <= state["epoch"]:
+            epoch = state["epoch"] + 1
+        return epoch
+
+    # logs an enter or exit that was just applied to the floorPlan
+    def logTraffic(self, room, enter, door):
+        self.log.append(room, enter, door)
+
+    # True if it is time for the next checkpoint
+    def isDue(self):
+        return time.monotonic() - self.lastSaved >= self.interval
+
+    # hands a checkpoint to the writer thread, this should be called from the thread that logs traffic so the two agree
+    # counts and cameras are in the form encodeCheckpoint takes, if the last checkpoint is still waiting to be written this one replaces it
+    # returns False if a new log is being started, the checkpoint is skipped and isDue stays True so it is tried again
+    def save(self, counts, cameras):
+        with self.condition:
+            if self.rotating:
+                return False
+        self.lastSaved = time.monotonic()
+        epoch, offset = self.log.getPosition()
+        rotate = offset > self.maxLogBytes
+        if rotate:
+            # the new log will only hold what is logged after this point, so the checkpoint points at its start
+            newEpoch = self.newEpoch({"epoch": epoch})
+            data = encodeCheckpoint(newEpoch, logHeader.size, counts, cameras)
+        else:
+            newEpoch = epoch
+            data = encodeCheckpoint(epoch, offset, counts, cameras)
+        with self.condition:
+            self.pending = (data, newEpoch, offset, rotate)
+            self.rotating = rotate
+            self.condition.notify()
+        return True
+
+    def write(self):
+        while True:
+            with self.condition:
+                while self.pending is None and self.running:
+                    self.condition.wait()
+                if self.pending is None:
+                    return
+                data, epoch, offset, rotate = self.pending
+                self.pending = None
+                self.writing = True
+            try:
+                temporary = self.checkpointFile + ".tmp"
+                with open(temporary, "wb") as f:
+                    f.write(data)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(temporary, self.checkpointFile)
+                if rotate:
+                    self.log.rotate(epoch, offset)
+            except OSError as error:
+                print("checkpoint: failed to write ", self.checkpointFile, " ", error)
+            with self.condition:
+                self.writing = False
+                if rotate:
+                    self.rotating = False
+                self.condition.notify_all()
+
+    # writes any checkpoint that is still waiting and closes the event log
+    def close(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+            while self.writer.is_alive() and (self.pending is not None or self.writing):
+                self.condition.wait(0.1)
+        self.log.close()
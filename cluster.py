@@ -0,0 +1,473 @@
+# -*- coding: utf-8 -*-
+"""
+Splits the cameras of a large building between several computers
+
+a coordinator owns the floorPlan, every worker runs "Human Tracker.py" for the cameras it is given and sends only the
+enter and exit events of those cameras to the coordinator, which applies them to the floorPlan with movePerson
+
+cameras are given to workers by rendezvous hashing of their MAC address, so when a worker stops only its cameras move
+and when a worker joins it only takes about its share of cameras from the others
+a worker that says nothing for heartbeatTimeout seconds is considered dead and its cameras are given to the rest
+a worker asked to connect to a camera it doesn't own tells the camera to connect to the worker that does ("server <IP> <port>\\n")
+
+messages are single lines of JSON, worker -> coordinator:
+    {"type": "hello", "name": "worker1", "session": "...", "host": "192.168.1.20", "port": 25425}
+    {"type": "traffic", "id": 12, "camera": "FC:F5:C4:0C:6F:94", "kind": "enter", "direction": "Left"}
+    {"type": "heartbeat"}
+coordinator -> worker:
+    {"type": "assign", "cameras": {MAC: doors text or null}, "owners": {MAC: [host, port]}}
+    {"type": "ack", "id": 12}
+events are numbered and kept by the worker until they are acknowledged, so nothing is lost or counted twice if the link drops
+
+everything can be tried on one computer:
+    python cluster.py coordinator my_floor_plan.floorplan
+    python cluster.py worker worker1 --simulate 5
+    python cluster.py worker worker2 --simulate 5
+a real worker is started with:
+    python "Human Tracker.py" --worker 127.0.0.1:25428 --name worker1
+
+@author: Zac
+"""
+import os
+import json
+import time
+import zlib
+import random
+import socket
+import selectors
+import threading
+import argparse
+from collections import deque
+
+import floorPlan as fp
+import counters as cn
+import occupancyStream as oc
+
+coordinatorPort = 25428
+
+# returns the name of the worker that owns a camera, or None if there aren't any workers
+# every camera/worker pair gets a score and the highest scoring worker wins, so removing a worker only moves its own cameras
+def getOwner(MAC, workerNames):
+    if len(workerNames) == 0:
+        return None
+    return max(workerNames, key=lambda name: (zlib.crc32((MAC + "|" + name).encode()), name))
+
+def encodeMessage(message):
+    return (json.dumps(message, separators=(",", ":")) + "\n").encode()
+
+# removes every complete line from the front of buffer and returns them as messages, anything unreadable is skipped
+def splitMessages(buffer):
+    messages = []
+    while True:
+        end = buffer.find(b"\n")
+        if end == -1:
+            break
+        line = bytes(buffer[:end])
+        del buffer[:end + 1]
+        try:
+            messages.append(json.loads(line))
+        except ValueError:
+            print("cluster: invalid message ", line[:100])
+    return messages
+
+# a connection to the coordinator from a worker
+class workerState:
+    def __init__(self, sock):
+        self.socket = sock
+        self.input = bytearray()
+        self.output = b""
+        self.name = None # set once the worker has said hello
+        self.session = None
+        self.address = None # (host, port) cameras should connect to
+        self.lastHeard = time.monotonic()
+        self.writing = False
+
+# owns the floorPlan and hands the cameras in it out to workers
+# heartbeatTimeout = seconds a worker can say nothing before it is considered dead
+# occupancy = an occupancyServer to publish the room counts and events to, or None
+class coordinator:
+    def __init__(self, plan, port=coordinatorPort, bindAddress="0.0.0.0", heartbeatTimeout=5.0, occupancy=None):
+        self.plan = plan
+        self.port = port
+        self.bindAddress = bindAddress
+        self.heartbeatTimeout = heartbeatTimeout
+        self.occupancy = occupancy
+        self.cameraRooms = {} # MAC -> name of the room the camera is in
+        for room in plan.rooms:
+            if plan.rooms[room].camera not in (None, "none"):
+                self.cameraRooms[plan.rooms[room].camera] = room
+        self.peers = set() # every connected workerState
+        self.workers = {} # name -> workerState of every worker that has said hello
+        self.assignment = {} # MAC -> name of the worker that owns it
+        self.lastApplied = {} # worker name -> (session, id of the last event applied), used to skip events that are sent again
+        self.selector = None
+        self.lock = threading.Lock() # the room counts are read by other threads
+        self.counters = cn.counterSet("events", "duplicates", "unknownCameras", "rebalances", "moved")
+
+    # returns the counters along with the number of workers
+    def getCounters(self):
+        counters = self.counters.get()
+        with self.lock:
+            counters["workers"] = len(self.workers)
+        return counters
+
+    # returns room name -> number of people in the room
+    def getCounts(self):
+        with self.lock:
+            return dict((room, self.plan.rooms[room].peopleCount) for room in self.plan.rooms)
+
+    # returns worker name -> list of the MACs it owns
+    def getAssignment(self):
+        with self.lock:
+            owned = dict((name, []) for name in self.workers)
+            for (MAC, name) in self.assignment.items():
+                owned[name].append(MAC)
+            return owned
+
+    def send(self, worker, message):
+        worker.output += encodeMessage(message)
+        if not worker.writing:
+            worker.writing = True
+            self.selector.modify(worker.socket, selectors.EVENT_READ | selectors.EVENT_WRITE, worker)
+
+    # works out who owns every camera and sends each worker its cameras and where every other camera went
+    def rebalance(self):
+        names = sorted(self.workers)
+        assignment = dict((MAC, getOwner(MAC, names)) for MAC in self.cameraRooms) if len(names) > 0 else {}
+        moved = sum(1 for MAC in assignment if self.assignment.get(MAC) is not None and self.assignment[MAC] != assignment[MAC])
+        with self.lock:
+            self.assignment = assignment
+        self.counters.add("rebalances")
+        self.counters.add("moved", moved)
+        owners = dict((MAC, list(self.workers[name].address)) for (MAC, name) in assignment.items())
+        for name in names:
+            cameras = {}
+            for (MAC, owner) in assignment.items():
+                if owner == name:
+                    doorRegions = self.plan.rooms[self.cameraRooms[MAC]].doorRegions
+                    cameras[MAC] = fp.doorRegionsToText(doorRegions) if doorRegions else None
+            self.send(self.workers[name], {"type": "assign", "cameras": cameras, "owners": owners})
+        print("cluster: ", len(assignment), " cameras shared between ", len(names), " workers, ", moved, " moved")
+
+    def close(self, worker):
+        self.peers.discard(worker)
+        try:
+            self.selector.unregister(worker.socket)
+        except (KeyError, ValueError):
+            pass
+        worker.socket.close()
+        if worker.name is not None and self.workers.get(worker.name) is worker:
+            with self.lock:
+                del self.workers[worker.name]
+            print("cluster: worker ", worker.name, " left")
+            self.rebalance()
+
+    def handle(self, worker, message):
+        kind = message.get("type")
+        if kind == "hello":
+            name = str(message["name"])
+            old = self.workers.get(name)
+            if old is not None and old is not worker:
+                # the worker reconnected before its old connection timed out
+                old.name = None
+                self.close(old)
+            worker.name = name
+            worker.session = message["session"]
+            worker.address = (message["host"], int(message["port"]))
+            if self.lastApplied.get(name, (None, 0))[0] != worker.session:
+                self.lastApplied[name] = (worker.session, 0)
+            with self.lock:
+                self.workers[name] = worker
+            print("cluster: worker ", name, " joined from ", worker.address)
+            self.rebalance()
+        elif worker.name is None:
+            return # nothing is accepted before hello
+        elif kind == "traffic":
+            session, lastID = self.lastApplied[worker.name]
+            if message["id"] <= lastID:
+                self.counters.add("duplicates")
+                return
+            self.lastApplied[worker.name] = (session, message["id"])
+            room = self.cameraRooms.get(message["camera"])
+            if room is None:
+                self.counters.add("unknownCameras")
+                return
+            with self.lock:
+                self.plan.rooms[room].movePerson(message["direction"], message["kind"] == "enter")
+            self.counters.add("events")
+            if self.occupancy is not None:
+                self.occupancy.publishTraffic(room, message["kind"], message["direction"])
+                self.occupancy.publishCounts(self.getCounts())
+
+    def read(self, worker):
+        try:
+            data = worker.socket.recv(65536)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            data = b""
+        if not data:
+            self.close(worker)
+            return
+        worker.lastHeard = time.monotonic()
+        worker.input += data
+        if len(worker.input) > 1 << 20:
+            print("cluster: message too long, dropping worker")
+            self.close(worker)
+            return
+        for message in splitMessages(worker.input):
+            try:
+                self.handle(worker, message)
+            except (KeyError, TypeError, ValueError):
+                print("cluster: invalid message ", message)
+        if worker.name is not None and worker in self.peers:
+            self.send(worker, {"type": "ack", "id": self.lastApplied[worker.name][1]})
+
+    def write(self, worker):
+        try:
+            sent = worker.socket.send(worker.output)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            self.close(worker)
+            return
+        worker.output = worker.output[sent:]
+        if len(worker.output) == 0:
+            worker.writing = False
+            self.selector.modify(worker.socket, selectors.EVENT_READ, worker)
+
+    # drops workers that haven't said anything for heartbeatTimeout seconds
+    def checkHeartbeats(self):
+        now = time.monotonic()
+        for worker in list(self.peers):
+            if now - worker.lastHeard > self.heartbeatTimeout:
+                print("cluster: worker ", worker.name, " timed out")
+                self.close(worker)
+
+    # serves workers until isRunning() returns False, this blocks so it should be given its own thread
+    def run(self, isRunning):
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.bind((self.bindAddress, self.port))
+        listener.listen(128)
+        listener.setblocking(False)
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(listener, selectors.EVENT_READ, None)
+        lastChecked = time.monotonic()
+
+        while isRunning():
+            for (key, events) in self.selector.select(timeout=0.1):
+                if key.data is None:
+                    try:
+                        sock, address = listener.accept()
+                    except OSError:
+                        continue
+                    sock.setblocking(False)
+                    worker = workerState(sock)
+                    self.peers.add(worker)
+                    self.selector.register(sock, selectors.EVENT_READ, worker)
+                else:
+                    worker = key.data
+                    if events & selectors.EVENT_READ:
+                        self.read(worker)
+                    if events & selectors.EVENT_WRITE and worker in self.peers:
+                        self.write(worker)
+            if time.monotonic() - lastChecked >= 0.5:
+                self.checkHeartbeats()
+                lastChecked = time.monotonic()
+
+        for worker in list(self.peers):
+            worker.name = None # stopping, there is nobody to rebalance for
+            self.close(worker)
+        self.selector.close()
+        listener.close()
+
+# a worker's connection to the coordinator, it reconnects on its own if the link drops
+# cameraPort = the port this worker listens for cameras on
+# advertisedHost = the address cameras should use to reach this worker, None uses the address the coordinator is reached from
+# onAssign(cameras, previous) is called from the link's thread whenever the cameras this worker owns change,
+#   both are MAC -> doorRegions (or None)
+# maxUnacknowledged = the most events kept while the coordinator can't be reached, the oldest are dropped first
+class workerLink:
+    def __init__(self, name, coordinatorAddress, cameraPort, advertisedHost=None, heartbeatInterval=1.0, heartbeatTimeout=5.0, maxUnacknowledged=10000, onAssign=None):
+        self.name = name
+        self.coordinatorAddress = coordinatorAddress
+        self.cameraPort = cameraPort
+        self.advertisedHost = advertisedHost
+        self.heartbeatInterval = heartbeatInterval
+        self.heartbeatTimeout = heartbeatTimeout
+        self.maxUnacknowledged = maxUnacknowledged
+        self.onAssign = onAssign
+        self.session = os.urandom(8).hex() # lets the coordinator tell a restarted worker from a reconnected one
+        self.lock = threading.Lock()
+        self.unacknowledged = deque() # (id, encoded event) sent or waiting to be sent, removed once the coordinator acknowledges them
+        self.nextID = 1
+        self.cameras = {} # MAC -> doorRegions of the cameras this worker owns
+        self.owners = {} # MAC -> (host, port) of the worker that owns it
+        self.connected = False
+        self.dropped = 0 # events thrown away because the coordinator couldn't be reached for too long
+
+    # queues an enter or exit event to be sent to the coordinator, this never blocks
+    def sendTraffic(self, MAC, kind, direction):
+        with self.lock:
+            event = encodeMessage({"type": "traffic", "id": self.nextID, "camera": MAC, "kind": kind, "direction": direction})
+            self.unacknowledged.append((self.nextID, event))
+            self.nextID += 1
+            if len(self.unacknowledged) > self.maxUnacknowledged:
+                self.unacknowledged.popleft()
+                self.dropped += 1
+
+    # True if this worker owns the camera
+    def owns(self, MAC):
+        with self.lock:
+            return MAC in self.cameras
+
+    # returns (host, port) of the worker that owns the camera, or None if nobody does
+    def getOwner(self, MAC):
+        with self.lock:
+            return self.owners.get(MAC)
+
+    # returns a short description for the UI
+    def getStatus(self):
+        with self.lock:
+            if not self.connected:
+                status = "Worker " + self.name + ": no coordinator"
+            else:
+                status = "Worker " + self.name + ": " + str(len(self.cameras)) + " cameras"
+            if self.dropped > 0:
+                status += "\n" + str(self.dropped) + " events dropped"
+            return status
+
+    def handle(self, message):
+        kind = message.get("type")
+        if kind == "ack":
+            with self.lock:
+                while len(self.unacknowledged) > 0 and self.unacknowledged[0][0] <= message["id"]:
+                    self.unacknowledged.popleft()
+        elif kind == "assign":
+            cameras = {}
+            for (MAC, doors) in message["cameras"].items():
+                cameras[MAC] = fp.doorRegionsFromText(doors) if doors else None
+            with self.lock:
+                previous = self.cameras
+                self.cameras = cameras
+                self.owners = dict((MAC, tuple(owner)) for (MAC, owner) in message["owners"].items())
+            print("cluster: this worker owns ", len(cameras), " cameras")
+            if self.onAssign is not None:
+                self.onAssign(dict(cameras), previous)
+
+    # talks to the coordinator until the link drops or isRunning() returns False
+    def serve(self, sock, isRunning):
+        host = self.advertisedHost or sock.getsockname()[0]
+        sock.sendall(encodeMessage({"type": "hello", "name": self.name, "session": self.session, "host": host, "port": self.cameraPort}))
+        buffer = bytearray()
+        sentUpTo = 0 # every event up to this id has been sent on this connection
+        lastSent = time.monotonic()
+        lastHeard = time.monotonic()
+        selector = selectors.DefaultSelector()
+        selector.register(sock, selectors.EVENT_READ)
+        try:
+            while isRunning():
+                if len(selector.select(timeout=0.1)) > 0:
+                    data = sock.recv(65536)
+                    if not data:
+                        return
+                    lastHeard = time.monotonic()
+                    buffer += data
+                    for message in splitMessages(buffer):
+                        self.handle(message)
+                if time.monotonic() - lastHeard > self.heartbeatTimeout:
+                    print("cluster: coordinator stopped answering")
+                    return
+                with self.lock:
+                    events = [event for (eventID, event) in self.unacknowledged if eventID > sentUpTo]
+                    if len(events) > 0:
+                        sentUpTo = self.unacknowledged[-1][0]
+                if len(events) > 0:
+                    sock.sendall(b"".join(events))
+                    lastSent = time.monotonic()
+                elif time.monotonic() - lastSent >= self.heartbeatInterval:
+                    sock.sendall(encodeMessage({"type": "heartbeat"}))
+                    lastSent = time.monotonic()
+        finally:
+            selector.close()
+
+    # keeps a link to the coordinator open until isRunning() returns False, this blocks so it should be given its own thread
+    # the cameras this worker owns are kept while the coordinator can't be reached
+    def run(self, isRunning):
+        while isRunning():
+            try:
+                sock = socket.create_connection(self.coordinatorAddress, timeout=2)
+            except OSError:
+                time.sleep(1)
+                continue
+            sock.settimeout(2)
+            with self.lock:
+                self.connected = True
+            print("cluster: connected to the coordinator at ", self.coordinatorAddress)
+            try:
+                self.serve(sock, isRunning)
+            except (OSError, KeyError, TypeError, ValueError) as error:
+                print("cluster: lost the coordinator ", error)
+            with self.lock:
+                self.connected = False
+            sock.close()
+
+# splits "host:port" into (host, port)
+def parseAddress(text, defaultPort):
+    if ":" in text:
+        host, port = text.rsplit(":", 1)
+        return (host, int(port))
+    return (text, defaultPort)
+
+# stands in for a worker with no cameras attached, every owned camera sees someone walk through a random door now and then
+def simulate(link, eventsPerSecond, isRunning):
+    while isRunning():
+        time.sleep(1 / eventsPerSecond)
+        with link.lock:
+            cameras = list(link.cameras)
+        if len(cameras) > 0:
+            link.sendTraffic(random.choice(cameras), random.choice(["enter", "exit"]), random.choice(["Left", "Middle", "Right"]))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Runs the coordinator, or a simulated worker, of a Human Tracker cluster")
+    commands = parser.add_subparsers(dest="command")
+    coordinatorParser = commands.add_parser("coordinator", help="owns the floorPlan and hands cameras out to workers")
+    coordinatorParser.add_argument("floorplan")
+    coordinatorParser.add_argument("--port", type=int, default=coordinatorPort)
+    coordinatorParser.add_argument("--occupancy-port", type=int, default=None, help="also publish the room counts, see occupancyStream.py")
+    workerParser = commands.add_parser("worker", help="a worker with no cameras that makes up enter and exit events for testing")
+    workerParser.add_argument("name")
+    workerParser.add_argument("--coordinator", default="127.0.0.1:" + str(coordinatorPort))
+    workerParser.add_argument("--camera-port", type=int, default=25425)
+    workerParser.add_argument("--simulate", type=float, default=5.0, help="events per second")
+    args = parser.parse_args()
+
+    try:
+        if args.command == "coordinator":
+            plan = fp.createFloorPlanFromFile(args.floorplan)
+            if plan is None:
+                raise SystemExit(1)
+            occupancy = None
+            if args.occupancy_port is not None:
+                occupancy = oc.occupancyServer(port=args.occupancy_port)
+                threading.Thread(target=occupancy.run, args=(lambda: True,), daemon=True).start()
+            server = coordinator(plan, args.port, occupancy=occupancy)
+            if occupancy is not None:
+                occupancy.publishCounts(server.getCounts())
+            threading.Thread(target=server.run, args=(lambda: True,), daemon=True).start()
+            lastCounts = None
+            while True:
+                time.sleep(2)
+                counts = server.getCounts()
+                if counts != lastCounts:
+                    print("counts: ", counts, " total: ", sum(counts.values()), " ", server.getCounters())
+                    lastCounts = counts
+        elif args.command == "worker":
+            link = workerLink(args.name, parseAddress(args.coordinator, coordinatorPort), args.camera_port)
+            threading.Thread(target=link.run, args=(lambda: True,), daemon=True).start()
+            simulate(link, args.simulate, lambda: True)
+        else:
+            parser.print_help()
+    except KeyboardInterrupt:
+        pass
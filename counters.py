@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+"""
+Named counters that one thread adds to while another, usually the UI, reads them
+
+@author: Zac
+"""
+import threading
+
+# a fixed set of counters that all start at 0
+# names = the names of the counters
+class counterSet:
+    def __init__(self, *names):
+        self.lock = threading.Lock()
+        self.values = dict.fromkeys(names, 0)
+
+    def add(self, name, amount=1):
+        with self.lock:
+            self.values[name] += amount
+
+    # returns a copy of the counters so they can be read from another thread
+    def get(self):
+        with self.lock:
+            return dict(self.values)
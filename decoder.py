@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+"""
+Decodes JPEG images on a pool of threads
+
+OpenCV lets go of the GIL while it decodes so several images really are decoded at the same time
+when the network is only going to be given a small input, the JPEG is decoded at 1/2, 1/4 or 1/8 size,
+this is done while decompressing so the full size image is never created
+
+@author: Zac
+"""
+import os
+import struct
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import cv2
+
+# (factor, flag) from the most reduced to the least
+reductions = [(8, cv2.IMREAD_REDUCED_COLOR_8), (4, cv2.IMREAD_REDUCED_COLOR_4), (2, cv2.IMREAD_REDUCED_COLOR_2)]
+
+# reads the width and height out of a JPEG's start of frame marker without decoding it
+# returns (width, height) or None if it couldn't be found
+def getJpegSize(data):
+    i = 2 # skips the start of image marker
+    while i + 9 < len(data):
+        if data[i] != 0xFF:
+            return None
+        marker = data[i + 1]
+        if marker == 0xFF: # padding
+            i += 1
+            continue
+        length = struct.unpack(">H", data[i + 2:i + 4])[0]
+        # every start of frame marker except the ones that aren't (DHT, JPG and DAC)
+        if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+            height, width = struct.unpack(">HH", data[i + 5:i + 9])
+            return (width, height)
+        i += 2 + length
+    return None
+
+# the largest image a camera sends, see captureProfile.py
+maxFrameShape = (480, 640, 3)
+
+# returns (buffer, image) so images can be written into the same memory over and over instead of a new array for every image
+# buffer is a flat array big enough for the largest image a camera sends, it is only allocated the first time (or if an image is even bigger)
+# image is a shape sized view of the start of buffer, it is contiguous so OpenCV can write straight into it
+# a camera changing profile therefore doesn't allocate anything either
+def frameBuffer(buffer, shape, dtype=np.uint8):
+    size = int(np.prod(shape))
+    if buffer is None or buffer.size < size or buffer.dtype != dtype:
+        buffer = np.empty(max(size, int(np.prod(maxFrameShape))), dtype=dtype)
+    return (buffer, buffer[:size].reshape(shape))
+
+# decodes images on workers threads, every core is used if workers isn't given
+class frameDecoder:
+    def __init__(self, workers=None):
+        self.workers = workers or os.cpu_count() or 1
+        self.pool = ThreadPoolExecutor(max_workers=self.workers)
+
+    # returns the imread flag to decode an image of the given size with, so it comes out no narrower than targetWidth
+    def getFlag(self, size, targetWidth):
+        if size is not None and targetWidth is not None:
+            for (factor, flag) in reductions:
+                if size[0] / factor >= targetWidth:
+                    return flag
+        return cv2.IMREAD_COLOR
+
+    # decodes a JPEG, returns None if it isn't a valid image
+    # targetWidth = the width the image is going to be shrunk to anyway, None means it is wanted at full size
+    def decode(self, data, targetWidth=None):
+        flag = self.getFlag(getJpegSize(data), targetWidth)
+        return cv2.imdecode(np.frombuffer(data, np.uint8), flag)
+
+    # starts decoding a JPEG on the pool, returns a Future whose result is the image
+    def submit(self, data, targetWidth=None):
+        return self.pool.submit(self.decode, data, targetWidth)
+
+    def shutdown(self):
+        self.pool.shutdown(wait=True)
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+"""
+Runs the YOLO network on an image and returns the people it found
+
+detectPeople can either look at the whole image or only at a list of regions (the door regions from the floorPlan),
+regions are cropped out, run through the network together as a single batch and the boxes are moved back into
+the coordinates of the whole image
+
+@author: Zac
+"""
+import numpy as np
+import cv2
+
+requiredConfidence = 0.6
+nmsThreshold = 0.3 # threshold for non max suppression
+
+# returns the names of the layers YOLO outputs its detections from
+# older versions of OpenCV return the layer numbers as [[200], [227]] and newer versions as [200, 227]
+def getOutputLayerNames(net):
+    layerNames = net.getLayerNames()
+    return [layerNames[i - 1] for i in np.array(net.getUnconnectedOutLayers()).flatten()]
+
+# YOLO needs both sides of its input to be a multiple of 32, returns the closest size that is
+# if maxInputWidth is given, anything wider is scaled down to that width first, keeping its shape
+def getBlobSize(width, height, maxInputWidth=None):
+    if maxInputWidth is not None and width > maxInputWidth:
+        height = height * maxInputWidth / width
+        width = maxInputWidth
+    return (max(32, int(width / 32 + 0.5) * 32), max(32, int(height / 32 + 0.5) * 32))
+
+# turns fractional regions (x0, y0, x1, y1) into pixel regions for an image of the given size
+def scaleRegions(regions, width, height):
+    return [(int(x0 * width), int(y0 * height), int(x1 * width), int(y1 * height)) for (x0, y0, x1, y1) in regions]
+
+# splits the outputs of a batched forward pass into the outputs for each image in the batch
+# depending on the version of OpenCV, batched YOLO outputs are either (batch, rows, 85) or (batch * rows, 85)
+def splitBatch(outputs, batchSize):
+    perImage = [[] for i in range(batchSize)]
+    for output in outputs:
+        if output.ndim == 3:
+            parts = [output[i] for i in range(batchSize)]
+        else:
+            parts = np.array_split(output, batchSize)
+        for i in range(batchSize):
+            perImage[i].append(parts[i])
+    return perImage
+
+# runs net on image and returns (boxes, confidences) for every person found after non max suppression
+# boxes are [x, y, w, h] in the coordinates of image
+# regions = list of (x0, y0, x1, y1) pixel regions to look at instead of the whole image, all of them are run as one batch
+# minimumConfidence = detections below this are ignored
+# maxInputWidth = the widest input the network is given, see autotune.py
+def detectPeople(net, image, regions=None, layerNames=None, minimumConfidence=requiredConfidence, maxInputWidth=None):
+    if layerNames is None:
+        layerNames = getOutputLayerNames(net)
+    height, width = image.shape[:2]
+    if not regions:
+        regions = [(0, 0, width, height)]
+
+    crops = [image[y0:y1, x0:x1] for (x0, y0, x1, y1) in regions]
+    # every image in a batch has to be the same size, the biggest region decides it so nothing gets shrunk too much
+    blobSize = getBlobSize(max(x1 - x0 for (x0, y0, x1, y1) in regions), max(y1 - y0 for (x0, y0, x1, y1) in regions), maxInputWidth)
+
+    #blob is the object that the DNN will accept
+    blob = cv2.dnn.blobFromImages(crops, 1/255.0, blobSize, swapRB=True, crop=False)
+    net.setInput(blob)
+    outputs = net.forward(layerNames)
+    if len(regions) > 1:
+        outputs = splitBatch(outputs, len(regions))
+    else:
+        outputs = [outputs]
+
+    boxes = []
+    confidences = []
+    for (region, regionOutputs) in zip(regions, outputs):
+        x0, y0, x1, y1 = region
+        regionWidth = x1 - x0
+        regionHeight = y1 - y0
+        for output in regionOutputs:
+            for detection in output:
+                scores = detection[5:]
+                classID = np.argmax(scores)
+                confidence = scores[classID]
+
+                if confidence > minimumConfidence:
+                    if classID == 0: # 0 = person, we don't care about anything else that gets detected
+                        box = detection[0:4] * np.array([regionWidth, regionHeight, regionWidth, regionHeight])
+                        centerX, centerY, w, h = box.astype('int')
+                        x = int(centerX - (w / 2)) + x0
+                        y = int(centerY - (h / 2)) + y0
+                        boxes.append([x, y, int(w), int(h)])
+                        confidences.append(float(confidence))
+
+    # regions can overlap so the same person may have been found twice, non max suppression sorts that out
+    idxs = cv2.dnn.NMSBoxes(boxes, confidences, minimumConfidence, nmsThreshold)
+
+    people = []
+    peopleConfidences = []
+    if len(idxs) > 0:
+        for i in np.array(idxs).flatten():
+            people.append(boxes[i])
+            peopleConfidences.append(confidences[i])
+    return (people, peopleConfidences)
@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+"""
+Answers "brain address?" UDP broadcasts from ESP32-cams that are looking for the server
+
+Message format:
+        Incoming: "brain address?"
+        Server responds: "brain address:192.168.1.xxx"
+
+when the power comes back every camera in the building broadcasts at once and keeps retrying until it gets an answer,
+so the discoveryService is built to soak that up:
+    the address to hand out is worked out once per subnet and refreshed every refreshInterval seconds
+    a client that was answered less than coalesceWindow seconds ago is not answered again
+    no more than maxResponsesPerSecond answers are sent, anything over that is dropped and the camera will simply ask again
+    counters keep track of what happened to every packet
+
+@author: Zac
+"""
+import asyncio
+import socket
+import time
+
+import counters as cn
+
+# works out which of this computer's addresses a client should be given
+# if advertisedAddresses is given the one on the same /24 subnet as the client is used, otherwise the operating system is asked
+#   which address it would use to reach the client, this handles computers connected to several networks
+# answers are cached per subnet for refreshInterval seconds
+class addressCache:
+    def __init__(self, refreshInterval=30.0, advertisedAddresses=None):
+        self.refreshInterval = refreshInterval
+        self.advertisedAddresses = advertisedAddresses
+        self.cache = {} # subnet -> (address, time it was looked up)
+
+    # returns the first three numbers of an IPv4 address, "192.168.1.20" -> "192.168.1"
+    def getSubnet(self, IP):
+        return IP.rsplit(".", 1)[0]
+
+    # finds the address to give to a client without using the cache
+    def findAddress(self, clientIP):
+        if self.advertisedAddresses:
+            for address in self.advertisedAddresses:
+                if self.getSubnet(address) == self.getSubnet(clientIP):
+                    return address
+            return self.advertisedAddresses[0]
+        try:
+            # connecting a UDP socket doesn't send anything, it just picks the interface that leads to clientIP
+            probe = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            probe.connect((clientIP, 9))
+            address = probe.getsockname()[0]
+            probe.close()
+            if address != "0.0.0.0":
+                return address
+        except:
+            pass
+        return socket.gethostbyname(socket.gethostname())
+
+    # returns the address to give to a client, looking it up again if the cached one is too old
+    def lookup(self, clientIP):
+        subnet = self.getSubnet(clientIP)
+        now = time.monotonic()
+        if subnet in self.cache:
+            address, lookupTime = self.cache[subnet]
+            if now - lookupTime < self.refreshInterval:
+                return address
+        address = self.findAddress(clientIP)
+        self.cache[subnet] = (address, now)
+        return address
+
+# hands every received packet to the discoveryService
+class discoveryProtocol(asyncio.DatagramProtocol):
+    def __init__(self, service):
+        self.service = service
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, clientAddress):
+        self.service.handle(data, clientAddress, self.transport)
+
+# answers discovery requests on port, bindAddresses are the local addresses to listen on, "0.0.0.0" listens on every interface
+# coalesceWindow = seconds during which repeated requests from the same client are ignored
+# maxResponsesPerSecond = the most answers that will be sent in a second, short bursts of up to this many are allowed
+class discoveryService:
+    def __init__(self, port=25426, bindAddresses=("0.0.0.0",), coalesceWindow=1.0, maxResponsesPerSecond=500, refreshInterval=30.0, advertisedAddresses=None):
+        self.port = port
+        self.bindAddresses = bindAddresses
+        self.coalesceWindow = coalesceWindow
+        self.maxResponsesPerSecond = maxResponsesPerSecond
+        self.addresses = addressCache(refreshInterval, advertisedAddresses)
+        self.lastAnswered = {} # client IP -> time it was last answered
+        self.lastPruned = time.monotonic()
+        self.tokens = float(maxResponsesPerSecond)
+        self.lastRefill = time.monotonic()
+        self.counters = cn.counterSet("received", "answered", "coalesced", "rateLimited", "invalid")
+
+    # forgets clients that haven't been answered recently so lastAnswered can't grow forever
+    def prune(self, now):
+        if now - self.lastPruned < self.coalesceWindow * 10:
+            return
+        self.lastAnswered = {IP: answered for (IP, answered) in self.lastAnswered.items() if now - answered < self.coalesceWindow}
+        self.lastPruned = now
+
+    # decides whether to answer a single packet
+    def handle(self, data, clientAddress, transport):
+        self.counters.add("received")
+        if data != b"brain address?":
+            self.counters.add("invalid")
+            return
+        now = time.monotonic()
+        self.prune(now)
+        clientIP = clientAddress[0]
+        if now - self.lastAnswered.get(clientIP, -self.coalesceWindow) < self.coalesceWindow:
+            self.counters.add("coalesced")
+            return
+        self.tokens = min(float(self.maxResponsesPerSecond), self.tokens + (now - self.lastRefill) * self.maxResponsesPerSecond)
+        self.lastRefill = now
+        if self.tokens < 1:
+            self.counters.add("rateLimited")
+            return
+        self.tokens -= 1
+        message = "brain address:" + self.addresses.lookup(clientIP)
+        transport.sendto(message.encode(), clientAddress)
+        self.lastAnswered[clientIP] = now
+        self.counters.add("answered")
+
+    async def serve(self, isRunning):
+        loop = asyncio.get_running_loop()
+        transports = []
+        for address in self.bindAddresses:
+            transport, protocol = await loop.create_datagram_endpoint(lambda: discoveryProtocol(self), local_addr=(address, self.port))
+            transports.append(transport)
+        while isRunning():
+            await asyncio.sleep(0.1)
+        for transport in transports:
+            transport.close()
+
+    # answers requests until isRunning() returns False, this blocks so it should be given its own thread
+    def run(self, isRunning):
+        asyncio.run(self.serve(isRunning))
@@ -9,10 +9,14 @@ when saved to a file, the format is as follows:
     id rightRoom "name of right room"
     id camera "name of camera"
     id direction "N or E or S or W"
+    id doors "Left x0 y0 x1 y1, Middle x0 y0 x1 y1, Right x0 y0 x1 y1"
     
 id is just a number that is determined by the order that the rooms are added to the file,
 each room has a unique id.
 if any saved variables do not exist then they will simple be marked as "none".
+doors is optional and only written for rooms that have door regions, it describes where each door is in the camera's image,
+the coordinates are fractions of the image's width and height so they work for any resolution,
+any of the three doors can be left out
 
 @author: Zac
 """
@@ -21,9 +25,10 @@ if any saved variables do not exist then they will simple be marked as "none".
 # a room can have up to 3 doors, "Left", "Middle", and "Right"
 # camera will be mounted on the wall opposite of middle door, the camera is also facing the middle door
 # direction is the direction the camera is facing
+# doorRegions describes where each door is in the camera's image, "Left"/"Middle"/"Right" -> (x0, y0, x1, y1) as fractions of the image size
 class room:
     # creates a room, the only required argument is the roomName, the rest can be filled in later
-    def __init__(self, roomName, leftRoom=None, middleRoom=None, rightRoom=None, camera=None, direction="N"):
+    def __init__(self, roomName, leftRoom=None, middleRoom=None, rightRoom=None, camera=None, direction="N", doorRegions=None):
         self.roomName = roomName
         self.leftRoom = leftRoom
         self.middleRoom = middleRoom
@@ -34,6 +39,7 @@ class room:
         else:
             self.direction = "N"
             print("direction must be \"N\" or \"E\" or \"S\" or \"W\", defaulting to \"N\"")
+        self.doorRegions = doorRegions
         self.peopleCount = 0
     
     # increases the number of people in the room
@@ -189,6 +195,33 @@ class floorPlan:
             if i is not pr:
                 self.printRooms(i, num+1, r)
 
+# turns a room's doorRegions into the text saved in a .floorplan file
+def doorRegionsToText(doorRegions):
+    doors = []
+    for door in ["Left", "Middle", "Right"]:
+        if door in doorRegions:
+            doors.append(door + " " + " ".join(str(round(i, 4)) for i in doorRegions[door]))
+    return ", ".join(doors)
+
+# reads the doors text from a .floorplan file, returns None if it is "none"
+def doorRegionsFromText(text):
+    if text == "none":
+        return None
+    doorRegions = {}
+    for door in text.split(","):
+        splitDoor = door.split()
+        if len(splitDoor) != 5 or splitDoor[0] not in ["Left", "Middle", "Right"]:
+            print("invalid door region: " + door)
+            continue
+        x0, y0, x1, y1 = [min(1.0, max(0.0, float(i))) for i in splitDoor[1:]]
+        if x1 <= x0 or y1 <= y0:
+            print("invalid door region: " + door)
+            continue
+        doorRegions[splitDoor[0]] = (x0, y0, x1, y1)
+    if len(doorRegions) == 0:
+        return None
+    return doorRegions
+
 # accepts a floorPlan object and saves it to a .floorplan file
 # will not save an empty floorPlan
 def saveFloorPlanToFile(floorPlan, fileName):
@@ -224,6 +257,8 @@ def saveFloorPlanToFile(floorPlan, fileName):
             else:
                 text += "none\n"
             text += head + "direction " + floorPlan.rooms[i].direction + "\n"
+            if floorPlan.rooms[i].doorRegions:
+                text += head + "doors " + doorRegionsToText(floorPlan.rooms[i].doorRegions) + "\n"
             f.write(text)
             x += 1
         f.close()
@@ -232,6 +267,7 @@ def saveFloorPlanToFile(floorPlan, fileName):
         f.close()
 
 # reads a .floorplan file and builds a floorPlan object from that data
+# lines are grouped into rooms by their id so optional lines like doors may be left out
 # returns a floorPlan object if successful or None if it fails
 def createFloorPlanFromFile(fileName):
     if fileName[-10:] != ".floorplan":
@@ -252,29 +288,34 @@ def createFloorPlanFromFile(fileName):
             data.append(splitText)
         f.close()
         
-        dataRooms = []
-        for i in range(int(len(data) / 6)):
-            dataRooms.append(data[i * 6:i * 6 + 6])
+        dataRooms = {} # id -> {variable name: value}, dicts keep the order the rooms appear in the file
+        for i in data:
+            if len(i) < 3:
+                continue
+            if i[0] not in dataRooms:
+                dataRooms[i[0]] = {}
+            dataRooms[i[0]][i[1]] = i[2]
+        dataRooms = list(dataRooms.values())
         
         fp = floorPlan()
-        fp.firstRoom = dataRooms[0][0][2]
+        fp.firstRoom = dataRooms[0]["roomName"]
         for i in dataRooms:
-            r = room(roomName=i[0][2], camera=i[4][2], direction=i[5][2])
-            fp.rooms[i[0][2]] = r
+            r = room(roomName=i["roomName"], camera=i["camera"], direction=i["direction"], doorRegions=doorRegionsFromText(i.get("doors", "none")))
+            fp.rooms[i["roomName"]] = r
         
-        for i in range(len(fp.rooms)):
-            if dataRooms[i][1][2] != "none":
-                fp.rooms[dataRooms[i][0][2]].leftRoom = fp.rooms[dataRooms[i][1][2]]
+        for i in dataRooms:
+            if i["leftRoom"] != "none":
+                fp.rooms[i["roomName"]].leftRoom = fp.rooms[i["leftRoom"]]
             else:
-                fp.rooms[dataRooms[i][0][2]].leftRoom = None
-            if dataRooms[i][2][2] != "none":
-                fp.rooms[dataRooms[i][0][2]].middleRoom = fp.rooms[dataRooms[i][2][2]]
+                fp.rooms[i["roomName"]].leftRoom = None
+            if i["middleRoom"] != "none":
+                fp.rooms[i["roomName"]].middleRoom = fp.rooms[i["middleRoom"]]
             else:
-                fp.rooms[dataRooms[i][0][2]].middleRoom = None
-            if dataRooms[i][3][2] != "none":
-                fp.rooms[dataRooms[i][0][2]].rightRoom = fp.rooms[dataRooms[i][3][2]]
+                fp.rooms[i["roomName"]].middleRoom = None
+            if i["rightRoom"] != "none":
+                fp.rooms[i["roomName"]].rightRoom = fp.rooms[i["rightRoom"]]
             else:
-                fp.rooms[dataRooms[i][0][2]].rightRoom = None
+                fp.rooms[i["roomName"]].rightRoom = None
         
         return fp
     except:
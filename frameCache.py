@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+"""
+Spots images a camera has already sent so they don't have to be decoded and run through the network again
+
+a camera looking at a perfectly still scene often sends exactly the same JPEG over and over,
+each camera gets a duplicateCache that remembers the detection results of its last few images keyed on a hash of the JPEG bytes,
+when an image is found in the cache its old detection result is reused and it is never decoded
+
+nearDuplicates also catches images that are almost the same, it compares a tiny grayscale thumbnail of the image,
+the thumbnail is decoded at 1/8 size which is far cheaper than a full decode but isn't free so it is off by default
+
+@author: Zac
+"""
+import sys
+import zlib
+import threading
+from collections import OrderedDict
+import numpy as np
+import cv2
+
+# remembers the detection results of a camera's most recent images
+# maxEntries = the most results that are remembered, the least recently used one is forgotten first
+# nearDuplicates = if True images whose thumbnails are almost the same also count as duplicates
+# nearThreshold = the largest average difference in brightness (0 - 255) between two thumbnails that still counts as the same image
+class duplicateCache:
+    def __init__(self, maxEntries=8, nearDuplicates=False, nearThreshold=2.0):
+        self.maxEntries = maxEntries
+        self.nearDuplicates = nearDuplicates
+        self.nearThreshold = nearThreshold
+        self.entries = OrderedDict() # key -> (thumbnail or None, result)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.nearHits = 0
+        self.misses = 0
+
+    # a fast hash of the JPEG bytes, the length is included so two images would have to collide on both
+    def getKey(self, data):
+        return (len(data), zlib.crc32(data))
+
+    # returns a 16x12 grayscale thumbnail of the JPEG, decoding at 1/8 size means most of the image is never decompressed
+    def getThumbnail(self, data):
+        thumbnail = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_REDUCED_GRAYSCALE_8)
+        if thumbnail is None:
+            return None
+        return cv2.resize(thumbnail, (16, 12), interpolation=cv2.INTER_AREA).astype(np.int16)
+
+    # looks for data in the cache
+    # returns (result, entry), result is the cached detection result or None if data hasn't been seen before
+    # entry is what store() needs to remember the result of data once it has been worked out
+    def lookup(self, data):
+        key = self.getKey(data)
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return (self.entries[key][1], None)
+        thumbnail = None
+        if self.nearDuplicates:
+            thumbnail = self.getThumbnail(data)
+            if thumbnail is not None:
+                with self.lock:
+                    for (cachedKey, (cachedThumbnail, result)) in reversed(self.entries.items()):
+                        if cachedThumbnail is not None and np.abs(cachedThumbnail - thumbnail).mean() <= self.nearThreshold:
+                            self.entries.move_to_end(cachedKey)
+                            self.nearHits += 1
+                            return (result, None)
+        with self.lock:
+            self.misses += 1
+        return (None, (key, thumbnail))
+
+    # remembers the detection result of an image that lookup() didn't find
+    def store(self, entry, result):
+        key, thumbnail = entry
+        with self.lock:
+            self.entries[key] = (thumbnail, result)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxEntries:
+                self.entries.popitem(last=False)
+
+    # returns roughly how many bytes the cache is using
+    def getMemoryUsage(self):
+        with self.lock:
+            size = sys.getsizeof(self.entries)
+            for (key, (thumbnail, result)) in self.entries.items():
+                size += sys.getsizeof(key) + sys.getsizeof(result) + sum(sys.getsizeof(part) for part in result)
+                if thumbnail is not None:
+                    size += thumbnail.nbytes
+        return size
+
+    # returns (exact hits, near hits, misses)
+    def getStatistics(self):
+        with self.lock:
+            return (self.hits, self.nearHits, self.misses)
+
+    # returns the fraction of images that were found in the cache
+    def getHitRate(self):
+        hits, nearHits, misses = self.getStatistics()
+        total = hits + nearHits + misses
+        if total == 0:
+            return 0.0
+        return (hits + nearHits) / total
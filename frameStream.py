@@ -0,0 +1,224 @@
+# -*- coding: utf-8 -*-
+"""
+Receives images from the ESP32-cams without making the work thread wait for them
+
+there are three capture modes:
+    "request"  - the work thread sends "send image" and waits for the reply, this is the original behaviour and doesn't use this file
+    "prefetch" - "send image" is sent as soon as the previous image arrives (or as soon as the pollScheduler says the camera is due)
+                 so the camera captures and sends the next image while the server is busy with the current one
+    "push"     - the camera is sent "stream <fps>\n" and sends images on its own at that rate, "stream 0\n" stops it
+
+in both prefetch and push mode a single frameReceiver thread reads every camera's socket
+only the newest complete image of each camera is kept, the work thread takes it from the camera's latestFrame
+
+@author: Zac
+"""
+import selectors
+import threading
+import time
+
+JPEG_START = b"\xff\xd8"
+JPEG_END = b"\xff\xd9"
+captureModes = ["request", "prefetch", "push"]
+minStreamRate = 0.01 # the smallest rate "stream {:.2f}" can carry, anything lower would be sent as "stream 0.00" which stops the camera
+
+# holds the newest complete image from a camera
+# images are numbered in the order they arrive, an image that was never taken is replaced by the next one
+class latestFrame:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.data = None
+        self.sequence = 0 # sequence number of the image in data
+        self.consumed = 0 # sequence number of the last image that was taken
+        self.dropped = 0 # number of images that were replaced before they were taken
+
+    # stores a newly received image
+    def put(self, data):
+        with self.lock:
+            if self.data is not None:
+                self.dropped += 1
+            self.data = data
+            self.sequence += 1
+
+    # returns the newest image if it hasn't been taken yet, otherwise None
+    def take(self):
+        with self.lock:
+            data = self.data
+            self.data = None
+            if data is not None:
+                self.consumed = self.sequence
+            return data
+
+# removes every complete image from the front of buffer and returns them in the order they were received
+# anything after the last complete image is left in buffer since it is the start of the next image
+def splitImages(buffer):
+    images = []
+    while True:
+        end = buffer.find(JPEG_END)
+        if end == -1:
+            break
+        start = buffer.find(JPEG_START, 0, end)
+        if start == -1:
+            start = 0
+        images.append(bytes(buffer[start:end + 2]))
+        del buffer[:end + 2]
+    return images
+
+# the frameReceiver's information about a single camera
+class receiverState:
+    def __init__(self, connection):
+        self.connection = connection # (socket, address) as returned by accept()
+        self.socket = connection[0]
+        self.buffer = bytearray()
+        self.requestOutstanding = False
+        self.lastActivity = time.monotonic() # last time a request was sent or data was received
+        self.streamRate = None # the rate the camera was last told to stream at
+
+# reads images from every connected camera and keeps the newest one in each camera's frameSlot
+# mode = "prefetch" or "push"
+# connections and connectionsLock are the list of connectedDevices and the lock that guards it
+# scheduler is the pollScheduler that decides how often each camera sends an image
+# dropConnection(device, connection) closes a dead connection without touching a newer one the camera reconnected with
+# timeout = seconds without any data before a connection is considered dead
+class frameReceiver:
+    def __init__(self, mode, connections, connectionsLock, scheduler, dropConnection, timeout=2.0):
+        self.mode = mode
+        self.connections = connections
+        self.connectionsLock = connectionsLock
+        self.scheduler = scheduler
+        self.dropConnection = dropConnection
+        self.timeout = timeout
+        self.selector = selectors.DefaultSelector()
+        self.states = {} # MAC -> receiverState
+        self.running = False
+        self.thread = threading.Thread()
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    # stops the thread, tells streaming cameras to stop and puts the sockets back the way the request mode expects them
+    def stop(self):
+        self.running = False
+        if self.thread.is_alive():
+            self.thread.join()
+        for MAC in list(self.states):
+            state = self.states.pop(MAC)
+            try:
+                self.selector.unregister(state.socket)
+            except:
+                pass
+            try:
+                if self.mode == "push":
+                    state.socket.send("stream 0\n".encode("utf-8"))
+                state.socket.settimeout(self.timeout)
+            except:
+                pass
+        self.selector.close()
+
+    # closes a camera's connection, the listeningThread will give it a new one when it reconnects
+    def closeConnection(self, device, reason):
+        print(device.MAC, " connection closed because " + reason)
+        state = self.states.pop(device.MAC, None)
+        if state is not None:
+            try:
+                self.selector.unregister(state.socket)
+            except:
+                pass
+            self.dropConnection(device, state.connection)
+
+    # registers any new or reconnected sockets with the selector
+    def syncConnections(self, devices):
+        for device in devices:
+            connection = device.connection
+            state = self.states.get(device.MAC)
+            if state is not None and state.connection is connection:
+                continue
+            if state is not None:
+                self.states.pop(device.MAC)
+                try:
+                    self.selector.unregister(state.socket)
+                except:
+                    pass
+            if connection is None:
+                continue
+            connection[0].setblocking(False)
+            try:
+                self.selector.register(connection[0], selectors.EVENT_READ, device)
+            except KeyError:
+                # the file descriptor still belongs to a socket that was closed when another camera reconnected
+                self.selector.unregister(self.selector.get_map()[connection[0].fileno()].fileobj)
+                self.selector.register(connection[0], selectors.EVENT_READ, device)
+            self.states[device.MAC] = receiverState(connection)
+
+    # sends image requests in prefetch mode and stream rates in push mode, closes connections that went quiet
+    def sendCommands(self, devices):
+        now = time.monotonic()
+        for device in devices:
+            state = self.states.get(device.MAC)
+            if state is None:
+                continue
+            try:
+                if self.mode == "prefetch":
+                    if state.requestOutstanding:
+                        if now - state.lastActivity > self.timeout:
+                            self.closeConnection(device, "it timed out")
+                    elif self.scheduler.isDue(device.MAC):
+                        state.socket.send("send image".encode("utf-8"))
+                        state.requestOutstanding = True
+                        state.lastActivity = now
+                        self.scheduler.markPolled(device.MAC)
+                else:
+                    rate = max(self.scheduler.getTargetRate(device.MAC), minStreamRate)
+                    # only resends the rate when it changed noticeably so the camera isn't flooded with commands
+                    if state.streamRate is None or abs(rate - state.streamRate) > state.streamRate * 0.1:
+                        state.socket.send("stream {:.2f}\n".format(rate).encode("utf-8"))
+                        if state.streamRate is None:
+                            state.lastActivity = now
+                        state.streamRate = rate
+                    elif now - state.lastActivity > self.timeout + 1.0 / rate:
+                        self.closeConnection(device, "it stopped streaming")
+            except:
+                self.closeConnection(device, "request failed")
+
+    # reads whatever data is available and hands every complete image to the camera's frameSlot
+    def receive(self):
+        for (key, events) in self.selector.select(timeout=0.01):
+            device = key.data
+            state = self.states.get(device.MAC)
+            if state is None:
+                continue
+            try:
+                dataReceived = state.socket.recv(65536)
+            except BlockingIOError:
+                continue
+            except:
+                self.closeConnection(device, "it timed out")
+                continue
+            if len(dataReceived) == 0:
+                self.closeConnection(device, "no data received")
+                continue
+            state.buffer += dataReceived
+            state.lastActivity = time.monotonic()
+            images = splitImages(state.buffer)
+            if len(images) > 0:
+                device.frameSlot.put(images[-1])
+                if self.mode == "prefetch":
+                    state.requestOutstanding = False
+                else:
+                    for i in range(len(images)):
+                        self.scheduler.markPolled(device.MAC)
+
+    def run(self):
+        print("frameReceiver started in " + self.mode + " mode")
+        while self.running:
+            self.connectionsLock.acquire()
+            devices = list(self.connections)
+            self.connectionsLock.release()
+            self.syncConnections(devices)
+            self.sendCommands(devices)
+            if len(self.states) == 0:
+                time.sleep(0.01)
+                continue
+            self.receive()
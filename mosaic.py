@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+"""
+Shows every camera at once as a grid of small images on the UI's canvas
+
+the mosaic is a single image the size of the canvas that is allocated once and every camera gets a tile in it,
+a tile is only redrawn when its camera has a new image and the canvas is updated at most maxFps times a second,
+so the work the UI does stays about the same no matter how many cameras are connected
+
+@author: Zac
+"""
+import math
+import time
+import numpy as np
+import cv2
+from PIL import Image, ImageTk
+
+# shows images on a canvas through a single PhotoImage and canvas item
+# the PhotoImage is pasted into instead of a new one being created for every image, unless the image size changes
+class canvasView:
+    def __init__(self, canvas):
+        self.canvas = canvas
+        self.photo = None
+        self.item = None
+        self.size = None
+
+    # image is an RGB array
+    def show(self, image):
+        size = (image.shape[1], image.shape[0])
+        if size != self.size:
+            self.photo = ImageTk.PhotoImage(master=self.canvas, image=Image.fromarray(image))
+            self.size = size
+            if self.item is None:
+                self.item = self.canvas.create_image(0, 0, image=self.photo, anchor="nw")
+            else:
+                self.canvas.itemconfig(self.item, image=self.photo)
+        else:
+            self.photo.paste(Image.fromarray(image))
+
+# a grid of every camera's latest image
+# width, height = size of the mosaic, the same as the canvas it is shown on
+# maxFps = the most times a second the tiles are redrawn and the mosaic is shown
+class mosaicView:
+    def __init__(self, width=640, height=480, maxFps=5.0):
+        self.width = width
+        self.height = height
+        self.interval = 1 / maxFps
+        self.image = np.zeros((height, width, 3), dtype=np.uint8)
+        self.tiles = [] # (MAC, imageVersion) of the image drawn in each tile, None if nothing has been drawn yet
+        self.columns = 1
+        self.rows = 1
+        self.changed = True # True if the mosaic has changed since it was last shown
+        self.lastShown = 0.0
+
+    # splits the mosaic into a grid with room for count cameras and clears it
+    def setLayout(self, count):
+        self.columns = max(1, math.ceil(math.sqrt(count)))
+        self.rows = max(1, math.ceil(count / self.columns))
+        self.image[:] = 0
+        self.tiles = [None] * count
+        self.changed = True
+
+    # returns (x, y, width, height) of a tile in the mosaic
+    def getTile(self, index):
+        tileWidth = self.width // self.columns
+        tileHeight = self.height // self.rows
+        return ((index % self.columns) * tileWidth, (index // self.columns) * tileHeight, tileWidth, tileHeight)
+
+    # returns the index of the tile at (x, y) on the canvas, or None if there isn't one there
+    def getIndex(self, x, y):
+        tileWidth = self.width // self.columns
+        tileHeight = self.height // self.rows
+        if x < 0 or y < 0 or x >= tileWidth * self.columns:
+            return None
+        index = (y // tileHeight) * self.columns + x // tileWidth
+        if index >= len(self.tiles):
+            return None
+        return index
+
+    # makes the next refresh show the mosaic even if no camera has a new image, used when switching back to the mosaic
+    def redraw(self):
+        self.changed = True
+        self.lastShown = 0.0
+
+    # redraws the tiles of cameras with a new image and shows the mosaic in view if anything changed, at most maxFps times a second
+    # devices is the list of connectedDevices, connectionsLock must be held since their images are read
+    # returns True if the mosaic was shown
+    def refresh(self, devices, view):
+        now = time.monotonic()
+        if now - self.lastShown < self.interval:
+            return False
+        self.lastShown = now
+        if len(devices) != len(self.tiles):
+            self.setLayout(len(devices))
+        for (index, device) in enumerate(devices):
+            if device.image is None or self.tiles[index] == (device.MAC, device.imageVersion):
+                continue
+            x, y, tileWidth, tileHeight = self.getTile(index)
+            # the last row and column of each tile are left black as grid lines
+            # nearest neighbour only reads the pixels it keeps, so a tile costs the same however big the camera's image is
+            tile = cv2.resize(device.image, (max(1, tileWidth - 1), max(1, tileHeight - 1)), interpolation=cv2.INTER_NEAREST)
+            self.image[y:y + tile.shape[0], x:x + tile.shape[1]] = tile
+            if tileHeight >= 40:
+                cv2.putText(self.image, device.MAC[-5:], (x + 2, y + 12), cv2.FONT_HERSHEY_SIMPLEX, 0.35, (255, 255, 0), 1)
+            self.tiles[index] = (device.MAC, device.imageVersion)
+            self.changed = True
+        if not self.changed:
+            return False
+        view.show(self.image)
+        self.changed = False
+        return True
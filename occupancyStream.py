@@ -0,0 +1,293 @@
+# -*- coding: utf-8 -*-
+"""
+Publishes the number of people in each room to other programs over HTTP
+
+    GET /occupancy  - the current count of every room as JSON, the connection is closed afterwards
+    GET /events     - a Server-Sent Events stream, it starts with a "snapshot" of every room and then only sends what changes:
+        event: snapshot  data: {"sequence": 12, "rooms": {"Kitchen": 2, "Hall": 0}, "total": 2, "resync": false, "dropped": 0}
+        event: counts    data: {"sequence": 13, "rooms": {"Kitchen": 3}, "total": 3}
+        event: traffic   data: {"sequence": 14, "room": "Kitchen", "type": "enter", "direction": "Left", "time": 1700000000.0}
+    every message has its sequence number as its id, a comment line is sent every keepaliveInterval seconds so dead connections are noticed
+
+the UI thread only appends what changed to a queue, the server thread encodes each message once and hands the same bytes to every subscriber
+each subscriber has its own buffer of at most maxBufferedMessages messages, a subscriber that can't keep up has its buffer thrown away
+and is sent a fresh snapshot (with "resync": true and the number of messages it missed) once it catches up,
+so a slow subscriber never holds up the tracking or the other subscribers
+
+@author: Zac
+"""
+import json
+import socket
+import selectors
+import threading
+import time
+from collections import deque
+
+import counters as cn
+
+# one client connected to the occupancyServer
+class subscriber:
+    def __init__(self, sock):
+        self.socket = sock
+        self.request = b"" # the HTTP request received so far
+        self.streaming = False # True once the client has asked for /events
+        self.messages = deque() # blocks of encoded messages waiting to be sent
+        self.buffered = 0 # number of messages in messages
+        self.output = b"" # bytes being sent right now
+        self.needsSnapshot = False # True if messages were thrown away and a snapshot has to be sent instead
+        self.dropped = 0 # messages thrown away since the last snapshot
+        self.closeWhenSent = False
+        self.writing = False # True if the selector is waiting for the socket to be writable
+        self.lastSent = time.monotonic() # the last time any bytes were sent to the client
+
+# serves room counts to other programs, see the top of this file
+# bindAddress = local address to listen on, "127.0.0.1" only allows programs on this computer, "0.0.0.0" allows any
+# maxBufferedMessages = the most messages kept for a subscriber before it is sent a snapshot instead
+class occupancyServer:
+    def __init__(self, port=25427, bindAddress="127.0.0.1", maxClients=1000, maxBufferedMessages=256, keepaliveInterval=15.0):
+        self.port = port
+        self.bindAddress = bindAddress
+        self.maxClients = maxClients
+        self.maxBufferedMessages = maxBufferedMessages
+        self.keepaliveInterval = keepaliveInterval
+        self.lock = threading.Lock()
+        self.published = deque() # (kind, data) waiting for the server thread, kind is "counts" or "traffic"
+        self.wakeRequested = False
+        self.wakeReader, self.wakeWriter = socket.socketpair()
+        self.wakeReader.setblocking(False)
+        self.wakeWriter.setblocking(False)
+        # everything below is only used by the server thread
+        self.counts = {} # room name -> count that was last sent to subscribers
+        self.sequence = 0
+        self.clients = set()
+        self.selector = None
+        self.counters = cn.counterSet("subscribers", "messages", "resyncs", "rejected") # read by the UI thread
+
+    # gives the server the current count of every room, only the rooms that changed are sent to subscribers
+    # counts = room name -> count, this never blocks so it is safe to call from the UI thread
+    def publishCounts(self, counts):
+        self.publish("counts", dict(counts))
+
+    # tells subscribers that someone entered or exited a room
+    # kind = "enter" or "exit", direction = the door they used, "Left", "Middle" or "Right"
+    def publishTraffic(self, roomName, kind, direction):
+        self.publish("traffic", {"room": roomName, "type": kind, "direction": direction, "time": time.time()})
+
+    def publish(self, kind, data):
+        with self.lock:
+            self.published.append((kind, data))
+            wake = not self.wakeRequested
+            self.wakeRequested = True
+        if wake:
+            try:
+                self.wakeWriter.send(b"\0")
+            except OSError:
+                pass # the server thread is already being woken up
+
+    # turns a message into the bytes of a Server-Sent Event
+    def encode(self, event, data):
+        return ("id: " + str(data["sequence"]) + "\nevent: " + event + "\ndata: " + json.dumps(data) + "\n\n").encode()
+
+    def getSnapshot(self, dropped=0, resync=False):
+        return {"sequence": self.sequence, "rooms": dict(self.counts), "total": sum(self.counts.values()), "resync": resync, "dropped": dropped}
+
+    # turns everything that was published into messages and gives them to every subscriber
+    # the messages are joined into one block first so each subscriber only has to be handed a single block
+    def distribute(self):
+        with self.lock:
+            published = self.published
+            self.published = deque()
+            self.wakeRequested = False
+        messages = []
+        for (kind, data) in published:
+            if kind == "counts":
+                changed = dict((room, count) for (room, count) in data.items() if self.counts.get(room) != count)
+                removed = [room for room in self.counts if room not in data]
+                if len(changed) == 0 and len(removed) == 0:
+                    continue
+                self.counts = data
+                self.sequence += 1
+                message = self.encode("counts", {"sequence": self.sequence, "rooms": changed, "total": sum(data.values())})
+            else:
+                self.sequence += 1
+                data["sequence"] = self.sequence
+                message = self.encode("traffic", data)
+            messages.append(message)
+        if len(messages) == 0:
+            return
+        self.counters.add("messages", len(messages))
+        block = b"".join(messages)
+        for client in self.clients:
+            if client.streaming:
+                self.queue(client, block, len(messages))
+
+    # adds a block of count messages to a subscriber's buffer
+    # if that would put more than maxBufferedMessages in it, the buffer is thrown away and the subscriber will be sent a snapshot instead
+    def queue(self, client, block, count=1):
+        if client.needsSnapshot:
+            client.dropped += count
+        elif client.buffered + count > self.maxBufferedMessages:
+            client.dropped += client.buffered + count
+            client.messages.clear()
+            client.buffered = 0
+            client.needsSnapshot = True
+            self.counters.add("resyncs")
+        else:
+            client.messages.append(block)
+            client.buffered += count
+        self.startWriting(client)
+
+    def startWriting(self, client):
+        if not client.writing:
+            client.writing = True
+            self.selector.modify(client.socket, selectors.EVENT_READ | selectors.EVENT_WRITE, client)
+
+    def accept(self, listener):
+        while True:
+            try:
+                sock, address = listener.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError:
+                return
+            if len(self.clients) >= self.maxClients:
+                self.counters.add("rejected")
+                try:
+                    sock.send(b"HTTP/1.1 503 Service Unavailable\r\nContent-Length: 0\r\nConnection: close\r\n\r\n")
+                except OSError:
+                    pass
+                sock.close()
+                continue
+            sock.setblocking(False)
+            client = subscriber(sock)
+            self.clients.add(client)
+            self.selector.register(sock, selectors.EVENT_READ, client)
+
+    def close(self, client):
+        if client.streaming:
+            self.counters.add("subscribers", -1)
+        self.clients.discard(client)
+        try:
+            self.selector.unregister(client.socket)
+        except (KeyError, ValueError):
+            pass
+        client.socket.close()
+
+    # reads the client's request, anything a subscriber sends after that is ignored
+    def read(self, client):
+        try:
+            data = client.socket.recv(4096)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            data = b""
+        if not data:
+            self.close(client)
+            return
+        if client.streaming or client.closeWhenSent:
+            return
+        client.request += data
+        if b"\r\n\r\n" not in client.request:
+            if len(client.request) > 8192:
+                self.close(client)
+            return
+        self.respond(client, client.request.split(b"\r\n", 1)[0].decode("latin-1").split(" "))
+
+    def respond(self, client, requestLine):
+        path = requestLine[1].split("?", 1)[0] if len(requestLine) >= 2 else ""
+        if len(requestLine) < 2 or requestLine[0] != "GET":
+            client.output = b"HTTP/1.1 405 Method Not Allowed\r\nContent-Length: 0\r\nConnection: close\r\n\r\n"
+            client.closeWhenSent = True
+        elif path == "/events":
+            client.output = b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nCache-Control: no-cache\r\nAccess-Control-Allow-Origin: *\r\n\r\n"
+            client.output += self.encode("snapshot", self.getSnapshot())
+            client.streaming = True
+            self.counters.add("subscribers")
+        elif path == "/occupancy":
+            body = json.dumps(self.getSnapshot()).encode()
+            client.output = b"HTTP/1.1 200 OK\r\nContent-Type: application/json\r\nAccess-Control-Allow-Origin: *\r\nContent-Length: " + str(len(body)).encode() + b"\r\nConnection: close\r\n\r\n" + body
+            client.closeWhenSent = True
+        else:
+            client.output = b"HTTP/1.1 404 Not Found\r\nContent-Length: 0\r\nConnection: close\r\n\r\n"
+            client.closeWhenSent = True
+        self.startWriting(client)
+
+    # sends as much of a client's buffer as its socket will take without blocking
+    def write(self, client):
+        while True:
+            if len(client.output) == 0:
+                if client.needsSnapshot:
+                    client.output = self.encode("snapshot", self.getSnapshot(client.dropped, True))
+                    client.needsSnapshot = False
+                    client.dropped = 0
+                elif len(client.messages) > 0:
+                    client.output = b"".join(client.messages)
+                    client.messages.clear()
+                    client.buffered = 0
+                elif client.closeWhenSent:
+                    self.close(client)
+                    return
+                else:
+                    client.writing = False
+                    self.selector.modify(client.socket, selectors.EVENT_READ, client)
+                    return
+            try:
+                sent = client.socket.send(client.output)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError:
+                self.close(client)
+                return
+            client.output = client.output[sent:]
+            client.lastSent = time.monotonic()
+            if len(client.output) > 0:
+                return # the socket is full, the rest is sent when it is writable again
+
+    # sends a comment to every idle subscriber so connections that have gone away are noticed
+    # clients that haven't taken any bytes (or never finished their request) for several keepalive intervals are disconnected
+    def keepalive(self):
+        now = time.monotonic()
+        for client in list(self.clients):
+            if (client.writing or not client.streaming) and now - client.lastSent > self.keepaliveInterval * 4:
+                self.close(client)
+            elif client.streaming and not client.needsSnapshot and len(client.messages) == 0 and len(client.output) == 0:
+                self.queue(client, b": keepalive\n\n")
+
+    # serves clients until isRunning() returns False, this blocks so it should be given its own thread
+    def run(self, isRunning):
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.bind((self.bindAddress, self.port))
+        listener.listen(128)
+        listener.setblocking(False)
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(listener, selectors.EVENT_READ, None)
+        self.selector.register(self.wakeReader, selectors.EVENT_READ, "wake")
+        lastKeepalive = time.monotonic()
+
+        while isRunning():
+            for (key, events) in self.selector.select(timeout=0.1):
+                if key.data is None:
+                    self.accept(listener)
+                elif key.data == "wake":
+                    try:
+                        while self.wakeReader.recv(4096):
+                            pass
+                    except (BlockingIOError, InterruptedError):
+                        pass
+                    self.distribute()
+                else:
+                    client = key.data
+                    if events & selectors.EVENT_READ:
+                        self.read(client)
+                    if events & selectors.EVENT_WRITE and client in self.clients:
+                        self.write(client)
+            if time.monotonic() - lastKeepalive >= self.keepaliveInterval:
+                self.keepalive()
+                lastKeepalive = time.monotonic()
+
+        for client in list(self.clients):
+            self.close(client)
+        self.selector.unregister(self.wakeReader)
+        self.selector.close()
+        listener.close()
@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+"""
+Decides how often each connected ESP32-cam should be polled for an image
+
+every camera is given a target frame rate somewhere between heartbeatRate and maxRate
+the rate depends on how busy the camera has been recently (people being tracked and enter/exit events)
+and on a global budget of how many inferences per second the server can afford
+
+a camera that sees nothing backs off to heartbeatRate,
+any spare budget is handed out to the busy cameras in proportion to their activity,
+only what the busy cameras can't use because they are at maxRate is shared between the idle ones
+
+@author: Zac
+"""
+import time
+import threading
+
+# stores the scheduling information for a single camera
+class cameraSchedule:
+    def __init__(self, rate):
+        self.activity = 0.0 # decaying score, people being tracked and recent enter/exit events push it up
+        self.lastActivityUpdate = time.monotonic()
+        self.targetRate = rate # frames per second this camera should be polled at
+        self.lastPoll = 0.0
+        self.measuredRate = 0.0 # frames per second this camera is actually being polled at
+
+# keeps a cameraSchedule for every camera and recalculates the target rates whenever activity is reported
+# heartbeatRate = the rate an idle camera is polled at
+# maxRate = the highest rate any single camera will be polled at
+# cpuBudget = fraction of the work thread's time that may be spent on inference, 1.0 means it never idles
+# activityHalfLife = seconds it takes for a camera's activity score to halve once it stops seeing people
+# eventWeight = how much a single enter/exit event counts compared to a person that is being tracked
+class pollScheduler:
+    def __init__(self, heartbeatRate=1.0, maxRate=15.0, cpuBudget=1.0, activityHalfLife=10.0, eventWeight=3.0):
+        self.heartbeatRate = heartbeatRate
+        self.maxRate = maxRate
+        self.cpuBudget = cpuBudget
+        self.activityHalfLife = activityHalfLife
+        self.eventWeight = eventWeight
+        self.inferenceTime = None # moving average of how long one detection takes in seconds
+        self.cameras = {} # MAC -> cameraSchedule
+        self.lock = threading.Lock()
+
+    # returns the cameraSchedule for MAC, creating one if this camera hasn't been seen before
+    # only the polling path should call this, anything else could bring back a camera that was removed
+    # lock must already be held
+    def getSchedule(self, MAC):
+        if MAC not in self.cameras:
+            self.cameras[MAC] = cameraSchedule(self.heartbeatRate)
+            self.rebalance()
+        return self.cameras[MAC]
+
+    # total number of frames per second the server can afford to run through the network
+    def getBudget(self):
+        if self.inferenceTime is None or self.inferenceTime <= 0:
+            return float("inf")
+        return self.cpuBudget / self.inferenceTime
+
+    # lowers the activity score of a camera depending on how much time has passed since it was last updated
+    # lock must already be held
+    def decay(self, schedule, now):
+        elapsed = now - schedule.lastActivityUpdate
+        if elapsed > 0:
+            schedule.activity *= 0.5 ** (elapsed / self.activityHalfLife)
+            schedule.lastActivityUpdate = now
+
+    # recalculates the target rate of every camera
+    # every camera gets the heartbeatRate first, if the budget can't even cover that then it is shared equally
+    # whatever is left over is shared between the active cameras in proportion to their activity,
+    #   if they all reach maxRate what is still left is shared equally between the idle cameras, no camera goes above maxRate
+    # lock must already be held
+    def rebalance(self):
+        if len(self.cameras) == 0:
+            return
+        now = time.monotonic()
+        budget = self.getBudget()
+
+        heartbeat = min(self.heartbeatRate, budget / len(self.cameras))
+        for schedule in self.cameras.values():
+            self.decay(schedule, now)
+            schedule.targetRate = heartbeat
+
+        remaining = budget - heartbeat * len(self.cameras)
+        active = [schedule for schedule in self.cameras.values() if schedule.activity > 0.01]
+        idle = [schedule for schedule in self.cameras.values() if schedule.activity <= 0.01]
+        remaining = self.handOut(active, remaining, lambda schedule: schedule.activity)
+        self.handOut(idle, remaining, lambda schedule: 1.0)
+
+    # shares remaining frames per second between schedules in proportion to weight(schedule), returns what couldn't be handed out
+    # any camera that hits maxRate gives its share back to the others
+    # lock must already be held
+    def handOut(self, schedules, remaining, weight):
+        while remaining > 1e-6 and len(schedules) > 0:
+            totalWeight = sum(weight(schedule) for schedule in schedules)
+            capped = []
+            handedOut = 0.0
+            for schedule in schedules:
+                share = remaining * weight(schedule) / totalWeight
+                if schedule.targetRate + share >= self.maxRate:
+                    share = self.maxRate - schedule.targetRate
+                    capped.append(schedule)
+                schedule.targetRate += share
+                handedOut += share
+            remaining -= handedOut
+            if len(capped) == 0:
+                break
+            schedules = [schedule for schedule in schedules if schedule not in capped]
+        return remaining
+
+    # tells the scheduler what the tracker saw in the latest frame from MAC
+    # activeObjects = number of people currently being tracked, events = number of enter/exit events in this frame
+    # ignored if MAC isn't being scheduled, which happens for frames that were already being detected when it was removed
+    def reportActivity(self, MAC, activeObjects, events):
+        with self.lock:
+            schedule = self.cameras.get(MAC)
+            if schedule is None:
+                return
+            self.decay(schedule, time.monotonic())
+            # the score settles at roughly the number of tracked people while they stay in view
+            schedule.activity = max(schedule.activity, activeObjects) + events * self.eventWeight
+            self.rebalance()
+
+    # tells the scheduler how long a single detection took so the global budget can be estimated
+    def reportInferenceTime(self, seconds):
+        with self.lock:
+            if self.inferenceTime is None:
+                self.inferenceTime = seconds
+            else:
+                self.inferenceTime = self.inferenceTime * 0.9 + seconds * 0.1
+
+    # returns True if MAC should be asked for a new image
+    def isDue(self, MAC):
+        with self.lock:
+            schedule = self.getSchedule(MAC)
+            return time.monotonic() - schedule.lastPoll >= 1.0 / schedule.targetRate
+
+    # records that MAC was just polled and updates its measured frame rate
+    def markPolled(self, MAC):
+        with self.lock:
+            schedule = self.getSchedule(MAC)
+            now = time.monotonic()
+            if schedule.lastPoll > 0:
+                interval = now - schedule.lastPoll
+                if interval > 0:
+                    if schedule.measuredRate == 0:
+                        schedule.measuredRate = 1.0 / interval
+                    else:
+                        schedule.measuredRate = schedule.measuredRate * 0.8 + (1.0 / interval) * 0.2
+            schedule.lastPoll = now
+
+    # stops scheduling MAC and gives its share of the budget to the other cameras
+    def removeCamera(self, MAC):
+        with self.lock:
+            if MAC in self.cameras:
+                self.cameras.pop(MAC)
+                self.rebalance()
+
+    # returns the rate MAC should send images at in "push" mode, it starts being scheduled if it wasn't already
+    def getTargetRate(self, MAC):
+        with self.lock:
+            return self.getSchedule(MAC).targetRate
+
+    # returns (targetRate, measuredRate) for MAC in frames per second, (0, 0) if it isn't being scheduled
+    def getRates(self, MAC):
+        with self.lock:
+            schedule = self.cameras.get(MAC)
+            if schedule is None:
+                return (0.0, 0.0)
+            return (schedule.targetRate, schedule.measuredRate)